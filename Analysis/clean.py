@@ -3,13 +3,18 @@
 # clean.py
 #
 # Clean-up the local replicate files in data/replicates that aren't needed.
+import argparse
 import os
+import shutil
 import sys
 
 # From the PSU-CIDD-MaSim-Support repository
 sys.path.insert(1, '../../PSU-CIDD-MaSim-Support/Python/include')
 from database import select
 
+# The local mirror of the database, see mirror.py
+import mirror
+
 # Connection string for the database
 CONNECTION = 'host=masimdb.vmhost.psu.edu dbname=rwanda user=sim password=sim connect_timeout=60'
 
@@ -31,6 +36,7 @@ def main():
     replicates = []
     for row in get_replicates():
         replicates.append('{}.csv'.format(row[2]))
+        replicates.append('{}.cols'.format(row[2]))
     
     # Load the replicates from the file system
     files = os.listdir(PATH)
@@ -39,11 +45,21 @@ def main():
     count = 0
     for file in files:
         if file not in replicates:
-            os.remove(os.path.join(PATH, file))
+            # Columnar replicates are stored as a directory
+            if os.path.isdir(os.path.join(PATH, file)):
+                shutil.rmtree(os.path.join(PATH, file))
+            else:
+                os.remove(os.path.join(PATH, file))
             count += 1
 
     print('Cached replicates deleted:', count) 
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mirror', action='store', dest='mirror', default=None, help='The path of a local mirror of the database to use in place of the database')
+    args = parser.parse_args()
+    if args.mirror is not None:
+        CONNECTION, select = args.mirror, mirror.select
+
     main()
\ No newline at end of file
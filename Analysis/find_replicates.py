@@ -5,29 +5,43 @@
 # Find replicates that approximate the mean and IQR provided.
 #
 # NOTE This script can only be run after data is cached by the 
-#      rwa_national_plot.py script.
+#      rwa_national_plot.py script, see rwa_cache.py.
+import argparse
 import csv
 import numpy as np
 import os
-import pandas as pd
 import sys
 
 # From the PSU-CIDD-MaSim-Support repository
 sys.path.insert(1, '../../PSU-CIDD-MaSim-Support/Python/include')
 from database import select
 
+# From the Plotting directory
+sys.path.insert(1, '../Plotting')
+import rwanda
+import rwa_cache
+import rwa_schema
+
+# The local mirror of the database, see mirror.py
+import mirror
+
 # Number of replicates to report
 COUNT = 5
 
 # The offset is the last month, ten years after intervention
 OFFSET = 12
 
-# The path for the cache file created by rwa_national_plot.py
-CACHE_FILE = '../Ploting/np/violin-cache-2024-10-all.npy'
+# The cache created by rwa_national_plot.py, for the study year and filter year
+CACHE_DIRECTORY = '../Plotting/np/cache'
+CACHE_YEAR, CACHE_FILTER = 2024, 10
 
 # Connection string for the database
 CONNECTION = 'host=masimdb.vmhost.psu.edu dbname=rwanda user=sim password=sim connect_timeout=60'
 
+# Path to a local mirror of the database to use in place of the database, this
+# is set by the --mirror argument
+MIRROR = None
+
 # The path to the data sets, genotype outputs
 DATASET_PATH = 'ms_data/2024/datasets/'
 GENOTYPE_PATH = 'data/heatmaps/'
@@ -43,18 +57,15 @@ PLOTS = [
     'rwa-mft-al-dhappq-0.25.csv'        # AL (75%) + DHA-PPQ (25%)
 ]
 
-# Get the percentile data from the cache file
-def get_percentiles(filename):
+# Get the percentile data from the cache
+def get_percentiles(year, filter_year):
 
-    # Verify that the cache exists
-    if not os.path.isfile(filename):
-        print('Cache file {} does not exist!'.format(filename))
+    # Load the cache, verifying that it exists
+    data = rwa_cache.load(rwanda.national_cache_key(year, filter_year), CACHE_DIRECTORY)
+    if data is None:
+        print('Cache for {}, filter on year {}, does not exist!'.format(year, filter_year))
         sys.exit(1)
 
-    # Load the cache file
-    data = np.load(filename, allow_pickle=True)
-    data = dict(enumerate(data.flatten(), 0))[0]
-
     # Generate a dictionary of files and the percentiles
     results = {}
     for key in data.keys():
@@ -82,10 +93,10 @@ def load_data(report, type, postfix):
 
 # Scan the replicate data to see if it is within the relevant bounds
 def scan(filename, lower, mean, upper):
-    REPLICATE, DATES,  INDIVIDUALS, WEIGHTED = 1, 2, 4, 8
+    REPLICATE, DATES, INDIVIDUALS, WEIGHTED = rwa_schema.DISTRICT.indices('replicate', 'dates', 'infections', 'weighted')
     
     # Load the data
-    dataset = pd.read_csv(os.path.join(DATASET_PATH, filename), header = None)
+    dataset = rwanda.read_dataset(os.path.join(DATASET_PATH, filename), [REPLICATE, DATES, INDIVIDUALS, WEIGHTED], memo=False)
 
     # Calculate the bounds
     lower = [lower, lower * 1.025]
@@ -153,10 +164,24 @@ def select_frequencies(replicate):
             WHERE md.replicateid = %(replicate)s AND md.dayselapsed > 4015
             GROUP BY md.id) msd 
         ON msd.id = mgd.id) frequency inner join sim.genotype g on g.id = frequency.genomeid"""
-    return select(CONNECTION, sql, {'replicate': replicate})
+    return query(sql, {'replicate': replicate})
+
+
+# Run the query against the local mirror when one is set, otherwise against the
+# database
+def query(sql, parameters):
+    if MIRROR is not None:
+        return mirror.select(MIRROR, sql, parameters)
+    return select(CONNECTION, sql, parameters)
 
 
 if __name__ == '__main__':
-    percentiles = get_percentiles(CACHE_FILE)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mirror', action='store', dest='mirror', default=None, help='The path of a local mirror of the database to use in place of the database')
+    args = parser.parse_args()
+    if args.mirror is not None:
+        MIRROR = args.mirror
+
+    percentiles = get_percentiles(CACHE_YEAR, CACHE_FILTER)
     for key in percentiles.keys():
         scan(key, percentiles[key][0], percentiles[key][1], percentiles[key][2])
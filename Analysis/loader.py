@@ -19,11 +19,21 @@
 # Study ID 19 - Intervention started in 2023
 # Study ID 20 - Intervention started in 2024
 import argparse
+import concurrent.futures
 import csv
 import datetime
+import decimal
+import hashlib
+import itertools
+import numpy as np
 import os
 import pandas as pd
+import psycopg2
 import sys
+import time
+
+# The local mirror of the database, see mirror.py
+import mirror
 
 # From the PSU-CIDD-MaSim-Support repository
 sys.path.insert(1, '../../PSU-CIDD-MaSim-Support/Python/include')
@@ -33,13 +43,33 @@ from utility import progressBar
 # From the Plotting directory
 sys.path.insert(1, '../Plotting')
 import rwanda
+import rwa_schema
 
 # Connection string for the database
 CONNECTION = 'host=masimdb.vmhost.psu.edu dbname=rwanda user=sim password=sim connect_timeout=60'
 
+# Path to a local mirror of the database to use in place of the database, this
+# is set by the --mirror argument
+MIRROR = None
+
 # Path for the locally cached / processed data
 DATASET_DIRECTORY = 'data/datasets'
 REPLICATE_DIRECTORY = 'data/replicates'
+GENOTYPE_DATASET = 'data/genotype_dataset'
+GENOTYPE_DIRECTORY = 'data/genotype'
+
+# The configurations that the national genotype data is needed for, along with
+# any of the cycling configurations
+GENOTYPE_FILENAMES = ['rwa-ae-al-5.yml', 
+                      'rwa-pfpr-constant.yml',
+                      'rwa-replacement-dhappq.yml',
+                      'rwa-replacement-asaq.yml',
+                      'rwa-mft-asaq-dhappq-0.25.yml',
+                      'rwa-rotation-al-5.yml',
+                      'rwa-seq-al-asaq.yml',
+                      'rwa-seq-al-dhappq.yml',
+                      'rwa-seq-al-dhappq-pause.yml',
+                      'rwa-tact-alaq.yml']
 
 # Path for the replicates list
 REPLICATES_LIST = 'data/rwa-replicates.csv'
@@ -47,33 +77,36 @@ REPLICATES_LIST = 'data/rwa-replicates.csv'
 # The number of replicates to pull to the size as our data set
 REPLICATE_COUNT = 100
 
-def check_therapy_records(replicateId):
-  sql = """
-        SELECT count(*) FROM public.v_therapyrecords tr
-        WHERE tr.replicateid = %(replicateId)s"""
-  result = select(CONNECTION, sql, {'replicateId':replicateId})
-  return (result[0][0] > 0)
+# The number of replicate queries to keep in-flight at once, one is serial
+WORKERS = 1
 
+# The number of replicates to extract with a single query, and the number of 
+# rows to fetch per round trip when streaming the results back
+BATCH_SIZE = 1
+ITERSIZE = 10000
 
-def get_replicates(startDate, studyId):
-  sql = """
-      SELECT c.id AS configurationid, 
-        c.studyid, 
-        c.filename, 
-        r.id AS replicateid, 
-        r.starttime, 
-        r.endtime
-      FROM sim.replicate r
-        INNER JOIN sim.configuration c ON c.id = r.configurationid
-      WHERE r.starttime > to_date(%(startDate)s, 'YYYY-MM-DD')
-        AND r.endtime IS NOT NULL
-        AND c.studyid = %(studyId)s
-      ORDER BY c.id desc, c.studyid, c.filename, r.id"""
-  return select(CONNECTION, sql, {'startDate':startDate, 'studyId':studyId})
+# Flag to extract the replicates using COPY, in which case the CSV produced by
+# the database is written to the replicate files as opposed to the rows being
+# returned to Python, this is set by the --copy argument
+COPY = False
 
+# The format to store the replicates and datasets in, see rwanda.DATASET_FORMATS
+FORMAT = 'both'
 
-def get_replicate(replicateId):
-  sql = """
+# The fields in the manifest of replicates that is written alongside each
+# replicate directory when the replicates are downloaded, and the fields in the
+# manifest of the replicates that were merged into each data set
+MANIFEST_FIELDS = ['replicateid', 'rows', 'checksum', 'endtime', 'first', 'last', 'reference', 'therapy']
+DATASET_FIELDS = ['filename', 'replicates', 'signature']
+
+# The number of replicates to download between saves of the manifest
+MANIFEST_INTERVAL = 25
+
+# The queries used to extract the replicate data, these are written against a
+# list of replicate ids so that batches of replicates can be extracted with a
+# single query. The rows are ordered by the replicate id so that they can be
+# split apart by replicate on the client.
+REPLICATE_SQL = """
       SELECT c.id as configurationid, sd.replicateid, sd.dayselapsed,
         sd.district, infectedindividuals,  clinicalepisodes, 
         CASE WHEN gd.occurrences IS NULL THEN 0 else gd.occurrences END AS occurrences,
@@ -91,7 +124,7 @@ def get_replicate(replicateId):
           sum(genotypecarriers) as genotypecarriers
         FROM sim.monthlydata md
           INNER JOIN sim.monthlysitedata msd on msd.monthlydataid = md.id
-        WHERE md.replicateid = %(replicateId)s
+        WHERE md.replicateid = ANY(%(replicateIds)s)
           AND md.dayselapsed > (11 * 365)
         GROUP BY md.replicateid, md.dayselapsed, msd.location) sd
       LEFT JOIN (
@@ -102,7 +135,7 @@ def get_replicate(replicateId):
         FROM sim.monthlydata md
           INNER JOIN sim.monthlygenomedata mgd on mgd.monthlydataid = md.id
           INNER JOIN sim.genotype g on g.id = mgd.genomeid
-        WHERE md.replicateid = %(replicateId)s
+        WHERE md.replicateid = ANY(%(replicateIds)s)
           AND md.dayselapsed > (11 * 365)
           AND g.name ~ '^.....H.'
         GROUP BY md.replicateid, md.dayselapsed, mgd.location) gd ON (gd.replicateid = sd.replicateid 
@@ -111,14 +144,11 @@ def get_replicate(replicateId):
         INNER JOIN sim.replicate r on r.id = sd.replicateid
         INNER JOIN sim.configuration c on c.id = r.configurationid
       WHERE r.endtime is not null
-        AND r.id = %(replicateId)s
-      ORDER BY replicateid, dayselapsed"""
-  return select(CONNECTION, sql, {'replicateId':replicateId})  
-
+        AND r.id = ANY(%(replicateIds)s)
+      ORDER BY sd.replicateid, sd.dayselapsed"""
 
-# Get the replicate with therapy record data. 
-def get_replicate_tr(replicateId):
-  sql = """
+# Extract the replicate with therapy record data.
+REPLICATE_TR_SQL = """
       SELECT c.id as configurationid, sd.replicateid, sd.dayselapsed,
         sd.district, infectedindividuals,  clinicalepisodes, 
         CASE WHEN gd.occurrences IS NULL THEN 0 else gd.occurrences END AS occurrences,
@@ -134,7 +164,7 @@ def get_replicate_tr(replicateId):
           sum(genotypecarriers) as genotypecarriers
         FROM sim.monthlydata md
           INNER JOIN sim.monthlysitedata msd on msd.monthlydataid = md.id
-        WHERE md.replicateid = %(replicateId)s
+        WHERE md.replicateid = ANY(%(replicateIds)s)
           AND md.dayselapsed > (11 * 365)
         GROUP BY md.replicateid, md.dayselapsed, msd.location) sd
 	  LEFT JOIN (
@@ -143,7 +173,7 @@ def get_replicate_tr(replicateId):
           sum(tr.failure) AS treatmentfailures
         FROM sim.monthlydata md
           INNER JOIN sim.therapyrecord tr on tr.monthlydataid = md.id
-        WHERE md.replicateid = %(replicateId)s
+        WHERE md.replicateid = ANY(%(replicateIds)s)
           AND md.dayselapsed > (11 * 365)
         GROUP BY md.replicateid, md.dayselapsed, tr.locationid) trd ON (trd.replicateid = sd.replicateid 
           AND trd.dayselapsed = sd.dayselapsed
@@ -156,7 +186,7 @@ def get_replicate_tr(replicateId):
         FROM sim.monthlydata md
           INNER JOIN sim.monthlygenomedata mgd on mgd.monthlydataid = md.id
           INNER JOIN sim.genotype g on g.id = mgd.genomeid
-        WHERE md.replicateid = %(replicateId)s
+        WHERE md.replicateid = ANY(%(replicateIds)s)
           AND md.dayselapsed > (11 * 365)
           AND g.name ~ '^.....H.'
         GROUP BY md.replicateid, md.dayselapsed, mgd.location) gd ON (gd.replicateid = sd.replicateid 
@@ -165,13 +195,11 @@ def get_replicate_tr(replicateId):
         INNER JOIN sim.replicate r on r.id = sd.replicateid
         INNER JOIN sim.configuration c on c.id = r.configurationid
       WHERE r.endtime is not null
-        AND r.id = %(replicateId)s
-      ORDER BY replicateid, dayselapsed"""
-  return select(CONNECTION, sql, {'replicateId':replicateId})  
-
+        AND r.id = ANY(%(replicateIds)s)
+      ORDER BY sd.replicateid, sd.dayselapsed"""
 
-def get_genotype_replicate(replicateId):
-  sql = """
+# Extract the replicate with national genotype data.
+GENOTYPE_SQL = """
       SELECT monthly.replicateid, monthly.dayselapsed,
         population, infectedindividuals, clinicalepisodes, treatments, treatmentfailures, pfpr2to10,
         occurances_561h, clinical_561h, weighted_561h, 
@@ -187,7 +215,7 @@ def get_genotype_replicate(replicateId):
           round(cast(sum(msd.population * msd.pfpr2to10) / sum(msd.population) as decimal), 3) as pfpr2to10
         FROM sim.monthlydata md
           INNER JOIN sim.monthlysitedata msd on msd.monthlydataid = md.id
-        WHERE md.replicateid = %(replicateId)s
+        WHERE md.replicateid = ANY(%(replicateIds)s)
           AND md.dayselapsed > (11 * 365)
         GROUP BY md.replicateid, md.dayselapsed) as monthly INNER JOIN (
         SELECT md.replicateid, md.dayselapsed,
@@ -203,33 +231,193 @@ def get_genotype_replicate(replicateId):
         FROM sim.monthlydata md
           INNER JOIN sim.monthlygenomedata mgd on mgd.monthlydataid = md.id
           INNER JOIN sim.genotype g on g.id = mgd.genomeid
-        WHERE md.replicateid = %(replicateId)s
+        WHERE md.replicateid = ANY(%(replicateIds)s)
+          AND md.dayselapsed > (11 * 365)
+        GROUP BY md.replicateid, md.dayselapsed) as genotypes on (genotypes.replicateid = monthly.replicateid 
+          AND genotypes.dayselapsed = monthly.dayselapsed)
+      ORDER BY monthly.replicateid, monthly.dayselapsed"""
+
+# The unified query reads the monthly site and genome data for the replicates 
+# once, returning the sums by district that both the district and the national
+# genotype data sets are derived from. The therapy record sums are only joined
+# when needed, otherwise they are returned as nulls.
+UNIFIED_TEMPLATE = """
+      SELECT c.id as configurationid, sd.replicateid, sd.dayselapsed, sd.district,
+        population, weightedpfpr, infectedindividuals, clinicalepisodes, 
+        treatments, treatmentfailures, genotypecarriers,
+        {therapy_columns},
+        genomes,
+        occurrences_561h, clinical_561h, weighted_561h,
+        occurrences_plasmepsin2x, clinical_plasmepsin2x, weighted_plasmepsin2x,
+        occurrences_double, clinical_double, weighted_double
+      FROM (
+        SELECT md.replicateid, md.dayselapsed, msd.location AS district,
+          sum(msd.population) AS population,
+          sum(msd.population * msd.pfpr2to10) AS weightedpfpr,
+          sum(msd.infectedindividuals) AS infectedindividuals, 
+          sum(msd.clinicalepisodes) AS clinicalepisodes,
+          sum(msd.treatments) AS treatments,
+          sum(msd.treatmentfailures) as treatmentfailures,
+          sum(genotypecarriers) as genotypecarriers
+        FROM sim.monthlydata md
+          INNER JOIN sim.monthlysitedata msd on msd.monthlydataid = md.id
+        WHERE md.replicateid = ANY(%(replicateIds)s)
+          AND md.dayselapsed > (11 * 365)
+        GROUP BY md.replicateid, md.dayselapsed, msd.location) sd{therapy_join}
+      LEFT JOIN (
+        SELECT md.replicateid, md.dayselapsed, mgd.location AS district,
+          count(*) AS genomes,
+          sum(case when g.name ~ '^.....H.' then mgd.occurrences else 0 end) as occurrences_561h,
+          sum(case when g.name ~ '^.....H.' then mgd.clinicaloccurrences else 0 end) as clinical_561h,
+          sum(case when g.name ~ '^.....H.' then mgd.weightedoccurrences else 0 end) as weighted_561h,
+          sum(case when g.name ~ '^......2' then mgd.occurrences else 0 end) as occurrences_plasmepsin2x,
+          sum(case when g.name ~ '^......2' then mgd.clinicaloccurrences else 0 end) as clinical_plasmepsin2x,
+          sum(case when g.name ~ '^......2' then mgd.weightedoccurrences else 0 end) as weighted_plasmepsin2x,
+          sum(case when g.name ~ '^.....H2' then mgd.occurrences else 0 end) as occurrences_double,
+          sum(case when g.name ~ '^.....H2' then mgd.clinicaloccurrences else 0 end) as clinical_double,
+          sum(case when g.name ~ '^.....H2' then mgd.weightedoccurrences else 0 end) as weighted_double
+        FROM sim.monthlydata md
+          INNER JOIN sim.monthlygenomedata mgd on mgd.monthlydataid = md.id
+          INNER JOIN sim.genotype g on g.id = mgd.genomeid
+        WHERE md.replicateid = ANY(%(replicateIds)s)
+          AND md.dayselapsed > (11 * 365)
+        GROUP BY md.replicateid, md.dayselapsed, mgd.location) gd ON (gd.replicateid = sd.replicateid 
+          AND gd.dayselapsed = sd.dayselapsed
+          AND gd.district = sd.district)
+        INNER JOIN sim.replicate r on r.id = sd.replicateid
+        INNER JOIN sim.configuration c on c.id = r.configurationid
+      WHERE r.endtime is not null
+        AND r.id = ANY(%(replicateIds)s)
+      ORDER BY sd.replicateid, sd.dayselapsed, sd.district"""
+
+UNIFIED_SQL = UNIFIED_TEMPLATE.format(
+  therapy_columns = "NULL AS treatmentscompleted, NULL AS treatmentsfailed",
+  therapy_join = "")
+
+UNIFIED_TR_SQL = UNIFIED_TEMPLATE.format(
+  therapy_columns = "treatmentscompleted, treatmentsfailed",
+  therapy_join = """
+      LEFT JOIN (
+        SELECT md.replicateid, md.dayselapsed, tr.locationid as district,
+          sum(tr.completed) AS treatmentscompleted, 
+          sum(tr.failure) AS treatmentsfailed
+        FROM sim.monthlydata md
+          INNER JOIN sim.therapyrecord tr on tr.monthlydataid = md.id
+        WHERE md.replicateid = ANY(%(replicateIds)s)
           AND md.dayselapsed > (11 * 365)
-        GROUP BY md.replicateid, md.dayselapsed) as genotypes on (genotypes.dayselapsed = monthly.dayselapsed)
-      ORDER BY monthly.dayselapsed"""
-  return select(CONNECTION, sql, {'replicateId':replicateId})
+        GROUP BY md.replicateid, md.dayselapsed, tr.locationid) trd ON (trd.replicateid = sd.replicateid 
+          AND trd.dayselapsed = sd.dayselapsed
+          AND trd.district = sd.district)""")
 
 
-def merge_data(replicates, path, outfile):
-  # Read the first file so we have something to append to
-  infile = os.path.join(path, "{}.csv".format(replicates[0]))
-  data = pd.read_csv(infile, header=None)
+# Return the set of replicates, of those given, that have therapy records. This 
+# is done with a single query so the replicates do not need to be checked one 
+# at a time prior to being extracted.
+def get_therapy_records(replicateIds):
+  if len(replicateIds) == 0: return set()
+  sql = """
+        SELECT DISTINCT tr.replicateid FROM public.v_therapyrecords tr
+        WHERE tr.replicateid = ANY(%(replicateIds)s)"""
+  result = query(sql, {'replicateIds':list(replicateIds)})
+  return set([row[0] for row in result])
 
-  for replicate in replicates[1:]:
-    infile = os.path.join(path, "{}.csv".format(replicate))
-    working = pd.read_csv(infile, header=None)
-    data = data.append(working)
 
-  data.to_csv(outfile, header=None, index=False)
-    
+def get_replicates(startDate, studyId):
+  sql = """
+      SELECT c.id AS configurationid, 
+        c.studyid, 
+        c.filename, 
+        r.id AS replicateid, 
+        r.starttime, 
+        r.endtime
+      FROM sim.replicate r
+        INNER JOIN sim.configuration c ON c.id = r.configurationid
+      WHERE r.starttime > to_date(%(startDate)s, 'YYYY-MM-DD')
+        AND r.endtime IS NOT NULL
+        AND c.studyid = %(studyId)s
+      ORDER BY c.id desc, c.studyid, c.filename, r.id"""
+  return query(sql, {'startDate':startDate, 'studyId':studyId})
+
+
+def get_replicate(replicateId):
+  return query(REPLICATE_SQL, {'replicateIds':[replicateId]})
 
-def process_datasets():
+
+# Get the replicate with therapy record data. 
+def get_replicate_tr(replicateId):
+  return query(REPLICATE_TR_SQL, {'replicateIds':[replicateId]})
+
+
+def get_genotype_replicate(replicateId):
+  return query(GENOTYPE_SQL, {'replicateIds':[replicateId]})
+
+
+# Merge the replicates into the data set, this is done in a single pass over
+# the replicate files so the cost is linear in the number of replicates
+def merge_data(replicates, path, outfile, format=FORMAT):
+  filenames = [os.path.join(path, "{}.csv".format(replicate)) for replicate in replicates]
+  rwanda.merge_datasets(filenames, outfile, format)
+
+
+# Merge the data sets, each job is the list of replicates, the path they are
+# stored in, and the output filename. Data sets whose replicates are unchanged
+# since they were last merged are skipped. When more than one worker is 
+# requested the data sets are merged in parallel using a process pool.
+def merge(jobs, workers):
+  # Filter out the data sets that are unchanged since the last merge
+  pending, merged, manifests = [], {}, {}
+  for replicates, path, filename in jobs:
+    if path not in manifests:
+      manifests[path] = load_manifest(path)
+    directory = os.path.dirname(filename)
+    if directory not in merged: 
+      merged[directory] = load_manifest(directory, 'filename')
+    entry = {'filename': os.path.basename(filename), 
+             'replicates': ' '.join([str(replicate) for replicate in replicates]),
+             'signature': signature(replicates, manifests[path])}
+    previous = merged[directory].get(entry['filename'])
+    if previous is not None and previous['replicates'] == entry['replicates'] and previous['signature'] == entry['signature'] and rwanda.dataset_exists(filename):
+      continue
+    merged[directory][entry['filename']] = entry
+    pending.append((replicates, path, filename))
+  if len(pending) < len(jobs):
+    print("Skipping {} unchanged data sets".format(len(jobs) - len(pending)))
+  jobs = pending
+
+  count = 0
+  progressBar(count, len(jobs))
+  if workers <= 1:
+    for replicates, path, filename in jobs:
+      merge_data(replicates, path, filename, FORMAT)
+      count = count + 1
+      progressBar(count, len(jobs))
+  else:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+      futures = [executor.submit(merge_data, replicates, path, filename, FORMAT) for replicates, path, filename in jobs]
+      for future in concurrent.futures.as_completed(futures):
+        future.result()
+        count = count + 1
+        progressBar(count, len(jobs))
+
+  # Record the replicates merged into each data set
+  for directory in merged:
+    save_manifest(directory, merged[directory], DATASET_FIELDS)
+
+
+# Return the signature of the replicates that are merged into a data set, this
+# changes if any of the replicates are downloaded again or the format changes
+def signature(replicates, manifest):
+  checksums = [str(manifest[replicate]['checksum']) if replicate in manifest else '' for replicate in replicates]
+  value = ' '.join([str(replicate) for replicate in replicates] + checksums + [FORMAT])
+  return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def process_datasets(workers=WORKERS):
   print("Preparing data sets...")
   replicates = pd.read_csv(REPLICATES_LIST, header=None)
   configurations = replicates[2].unique()
 
-  count = 0
-  progressBar(count, len(configurations))
+  jobs = []
   for configuration in configurations:
     # Place the dataset in the correct directory
     directory = DATASET_DIRECTORY
@@ -237,16 +425,17 @@ def process_datasets():
     # Filter the replicates and merge the most recent entries for the dataset
     data = replicates[replicates[2] == configuration]
     filename = os.path.join(directory, configuration.replace('yml', 'csv'))
-    merge_data(data[-50:][3].to_numpy(), REPLICATE_DIRECTORY, filename)
-    count = count + 1
-    progressBar(count, len(configurations))
+    jobs.append((data[-50:][3].to_numpy(), REPLICATE_DIRECTORY, filename))
+  merge(jobs, workers)
 
 
-def process_final_datasets(date, path, results, count):
+def process_final_datasets(date, path, results, count, workers=WORKERS):
   print("Preparing data sets...")
   replicates = pd.read_csv(REPLICATES_LIST, header=None)
   configurations = replicates[2].unique()
+  summaries = load_manifest(path)
 
+  jobs = []
   for configuration in configurations:
     # Skip the spike configurations
     if 'spike' in configuration: 
@@ -269,10 +458,16 @@ def process_final_datasets(date, path, results, count):
       filename = "{}/{}.csv".format(path, row[3])
 
       # If the file doesn't exist, then skip
-      if not os.path.exists(filename):
+      if not rwanda.dataset_exists(filename):
         continue
 
-      if check_replicate(filename):
+      # Use the manifest if the replicate is present, otherwise check the file
+      if row[3] in summaries: 
+        passed = check_summary(summaries[row[3]])
+      else:
+        passed = check_replicate(filename)
+
+      if passed:
         valid.append(row[3])
 
         # Break if we have enough, even if there are still some pending.
@@ -280,58 +475,45 @@ def process_final_datasets(date, path, results, count):
         if len(valid) == target: 
           break
 
-    # Merge the files if we have results
+    # Queue the files to be merged if we have results
     if len(valid) > 0:
       filename = os.path.join(results, configuration.replace('yml', 'csv'))
-      merge_data(valid, path, filename)
+      jobs.append((valid, path, filename))
 
     # Update the user
     print("{}: {}".format(configuration, len(valid)))
 
+  # Merge the data sets
+  merge(jobs, workers)
+
 
 def check_replicate(filename):
-  DATES, DISTRICT, INDIVIDUALS, WEIGHTED = 2, 3, 4, 8
+  DATES, DISTRICT, INDIVIDUALS, WEIGHTED = rwa_schema.DISTRICT.indices('dates', 'district', 'infections', 'weighted')
 
   # If this is a genotype data set then it automatically gets a pass
   if 'genotype' in filename:
     return True
 
-  # Load the data, note the unique dates, replicates
-  data = pd.read_csv(filename, header = None)
-  dates = data[DATES].unique().tolist()
-  startDate = datetime.datetime.strptime(rwanda.STUDYDATE, "%Y-%m-%d")
-
-  # Scan until the date matches the reference date
-  for date in dates:    
+  # Load the data for the reference date, note the reference district
+  data = rwanda.read_dataset(filename, [DATES, DISTRICT, INDIVIDUALS, WEIGHTED], rwanda.REFERENCEDATE, rwanda.REFERENCEDATE, memo=False)
+  data = data[data[DISTRICT] == rwanda.REFERENCEDISTRICT]
 
-    # Verify the frequency if this is the correct date
-    currentDate = startDate + datetime.timedelta(days=date)
-    if currentDate == rwanda.REFERENCEDATE:
-      temp = data[data[DATES] == date]
-      temp = temp[temp[DISTRICT] == rwanda.REFERENCEDISTRICT]
-
-      # Return false if the replicate is below the reference frequency
-      if (temp[WEIGHTED] / temp[INDIVIDUALS]).values[0] < rwanda.REFERENCEFREQUENCY:
-        return False
+  # Return false if the replicate is below the reference frequency
+  if len(data) > 0 and (data[WEIGHTED] / data[INDIVIDUALS]).values[0] < rwanda.REFERENCEFREQUENCY:
+    return False
 
   # Valid replicate to use
   return True
 
 
-def process_genotype(date, studyId, count):
-  GENOTYPE_DATASET = 'data/genotype_dataset'
-  GENOTYPE_DIRECTORY = 'data/genotype'
-  FILENAMES = ['rwa-ae-al-5.yml', 
-               'rwa-pfpr-constant.yml',
-               'rwa-replacement-dhappq.yml',
-               'rwa-replacement-asaq.yml',
-               'rwa-mft-asaq-dhappq-0.25.yml',
-               'rwa-rotation-al-5.yml',
-               'rwa-seq-al-asaq.yml',
-               'rwa-seq-al-dhappq.yml',
-               'rwa-seq-al-dhappq-pause.yml',
-               'rwa-tact-alaq.yml']
+# Check the replicate summary from the manifest to see if the replicate is valid
+def check_summary(summary):
+  if summary['reference'] in ['', None]:
+    return True
+  return float(summary['reference']) >= rwanda.REFERENCEFREQUENCY
+
 
+def process_genotype(date, studyId, count, workers=WORKERS, batchSize=BATCH_SIZE):
   if not os.path.exists(GENOTYPE_DATASET): os.makedirs(GENOTYPE_DATASET)
   if not os.path.exists(GENOTYPE_DIRECTORY): os.makedirs(GENOTYPE_DIRECTORY)
 
@@ -340,73 +522,458 @@ def process_genotype(date, studyId, count):
   save_csv(REPLICATES_LIST, replicates)
   
   print("Processing replicates...")  
-  count = 0; finalize = False
-  progressBar(count, len(replicates))
+  manifest, pending = load_manifest(GENOTYPE_DIRECTORY), []
   for row in replicates:
     # Pass if the replicate is too old or one that we care about
-    if (row[4].date() < datetime.datetime.strptime(date, '%Y-%m-%d').date()) or not (row[2] in FILENAMES or 'rwa-cycling-' in row[2]):
-      continue
+    if not is_genotype(row, date): continue
 
     # Check to see if we already have the data
     filename = os.path.join(GENOTYPE_DIRECTORY, "{}.csv".format(row[3]))
-    if os.path.exists(filename): continue
-
-    # Query and store the data
-    replicate = get_genotype_replicate(row[3])
-    save_csv(filename, replicate)
-    finalize = True
+    if is_current(manifest, row, filename): continue
+    pending.append((row[3], filename))
+  save_manifest(GENOTYPE_DIRECTORY, manifest, MANIFEST_FIELDS)
 
-    # Update the progress bar
-    count = count + 1
-    progressBar(count, len(replicates))
-
-  # Complete progress bar for replicates
-  if count != len(replicates): progressBar(len(replicates), len(replicates))  
+  # Download the replicates in batches, the data sets only need to be finalized
+  # if something was downloaded
+  jobs = [(download_genotype, batch) for batch in batches(pending, batchSize)]
+  summaries = download(jobs, len(replicates), workers, replicates)
+  finalize = (len(summaries) > 0)
 
   # Merge the data sets if they need to be finalized
   if finalize: 
-    process_final_datasets(date, GENOTYPE_DIRECTORY, GENOTYPE_DATASET, count)
+    process_final_datasets(date, GENOTYPE_DIRECTORY, GENOTYPE_DATASET, count, workers)
 
 
 # Process the replicates to make sure we have all of the data we need locally
-def process_replicates(date, studyId):
+def process_replicates(date, studyId, workers=WORKERS, batchSize=BATCH_SIZE):
   print("Querying for replicates list...")
   replicates = get_replicates(date, studyId)
   save_csv(REPLICATES_LIST, replicates)
   
   print("Processing replicates...")  
-  count = 0; therapy_records = False
-  progressBar(count, len(replicates))
+  manifest, pending = load_manifest(REPLICATE_DIRECTORY), []
   for row in replicates:
     # Check to see if we already have the data
     filename = os.path.join(REPLICATE_DIRECTORY, "{}.csv".format(row[3]))
-    if os.path.exists(filename): continue
+    if is_current(manifest, row, filename): continue
+    pending.append((row[3], filename))
+  save_manifest(REPLICATE_DIRECTORY, manifest, MANIFEST_FIELDS)
 
-    # Query and store the data
-    replicateId = row[3]
-    if check_therapy_records(replicateId):
-      replicate = get_replicate_tr(replicateId)
-      therapy_records = True
-    else:
-      replicate = get_replicate(replicateId)
-    save_csv(filename, replicate)
+  # Note which replicates have therapy records so they can be batched by query
+  therapy = get_therapy_records([replicateId for replicateId, filename in pending])
+  jobs = [(download_replicate_tr, batch) for batch in batches([item for item in pending if item[0] in therapy], batchSize)]
+  jobs.extend([(download_replicate, batch) for batch in batches([item for item in pending if item[0] not in therapy], batchSize)])
 
-    # Update the progress bar
-    count = count + 1
-    progressBar(count, len(replicates))
+  # Download the replicates in batches, note the use of therapy records
+  summaries = download(jobs, len(replicates), workers, replicates)
+  if any([summary['therapy'] for summary in summaries]): print('Used the therapyrecord table')
 
-  # Complete progress bar for replicates
-  if count != len(replicates): progressBar(len(replicates), len(replicates))
 
-  # Note the use of therapy records
-  if therapy_records: print('Used the therapyrecord table')
+# Process the replicates using the unified query, which reads the monthly site
+# and genome data for each replicate once and derives both the district and the
+# national genotype data sets from it. Returns True if any genotype replicates
+# were downloaded, in which case the genotype data sets need to be finalized.
+def process_unified(date, studyId, workers=WORKERS, batchSize=BATCH_SIZE):
+  print("Querying for replicates list...")
+  replicates = get_replicates(date, studyId)
+  save_csv(REPLICATES_LIST, replicates)
+
+  print("Processing replicates...")
+  manifest, genotypes, pending = load_manifest(REPLICATE_DIRECTORY), load_manifest(GENOTYPE_DIRECTORY), []
+  for row in replicates:
+    # Check to see if we already have the data, the genotype data is only 
+    # needed for some of the replicates
+    filename = os.path.join(REPLICATE_DIRECTORY, "{}.csv".format(row[3]))
+    genotype = os.path.join(GENOTYPE_DIRECTORY, "{}.csv".format(row[3])) if is_genotype(row, date) else None
+    if is_current(manifest, row, filename) and (genotype is None or is_current(genotypes, row, genotype)): continue
+    pending.append((row[3], filename, genotype))
+  save_manifest(REPLICATE_DIRECTORY, manifest, MANIFEST_FIELDS)
+  save_manifest(GENOTYPE_DIRECTORY, genotypes, MANIFEST_FIELDS)
+
+  # Note which replicates have therapy records so they can be batched by query
+  therapy = get_therapy_records([item[0] for item in pending])
+  jobs = [(download_unified_tr, batch) for batch in batches([item for item in pending if item[0] in therapy], batchSize)]
+  jobs.extend([(download_unified, batch) for batch in batches([item for item in pending if item[0] not in therapy], batchSize)])
+
+  # Download the replicates in batches, note the use of therapy records
+  summaries = download(jobs, len(replicates), workers, replicates)
+  if any([summary['therapy'] for summary in summaries]): print('Used the therapyrecord table')
+  return any([summary['directory'] == os.path.normpath(GENOTYPE_DIRECTORY) for summary in summaries])
+
+
+# Check to see if the national genotype data is needed for the replicate, this
+# requires the replicate to be recent enough and for a configuration we use
+def is_genotype(row, date):
+  if row[4].date() < datetime.datetime.strptime(date, '%Y-%m-%d').date(): return False
+  return row[2] in GENOTYPE_FILENAMES or 'rwa-cycling-' in row[2]
+
+
+# Check to see if the replicate returned by get_replicates is present in the 
+# manifest with the same end time and that the data for it exists with the rows
+# recorded. Replicates without an entry are added to the manifest if the data 
+# for them is complete (e.g., downloaded before the manifest was introduced), 
+# otherwise they may have been written partially so are downloaded again.
+def is_current(manifest, row, filename):
+  if row[3] not in manifest: return adopt(manifest, row, filename)
+  if manifest[row[3]]['endtime'] != str(row[5]): return False
+  if not rwanda.dataset_exists(filename): return False
+  return count_rows(filename) == int(manifest[row[3]]['rows'])
+
+
+# Add the replicate to the manifest if the data for it is complete, i.e., the 
+# district data has a row for every district on each date and the genotype data 
+# has one row for each date. Returns True if the replicate was added.
+def adopt(manifest, row, filename):
+  if not rwanda.dataset_exists(filename): return False
+  genotype = os.path.normpath(os.path.dirname(filename)) == os.path.normpath(GENOTYPE_DIRECTORY)
+  layout = rwa_schema.GENOTYPE if genotype else rwa_schema.DISTRICT
+  data = rwanda.read_dataset(filename, memo=False)
+  if len(data) == 0 or len(data.columns) != len(layout.columns): return False
+  counts = data.groupby(layout.index('dates')).size()
+  if (counts != (1 if genotype else len(rwanda.DISTRICTS))).any(): return False
+
+  summary = summarize(row[3], filename, data, genotype)
+  summary['endtime'] = str(row[5])
+  manifest[row[3]] = summary
+  return True
 
 
+# Return the number of rows in the dataset, the columnar copy is used when it
+# is present since the length can be read without parsing
+def count_rows(filename):
+  columnar = rwanda.columnar_path(filename)
+  if os.path.isdir(columnar):
+    first = os.path.join(columnar, '0.npy')
+    return len(np.load(first, mmap_mode='r')) if os.path.exists(first) else 0
+  with open(filename, 'rb') as infile:
+    return sum([1 for line in infile])
+
+
+# Split the list of (replicate id, filename) items into batches of the given size
+def batches(items, size):
+  size = max(size, 1)
+  return [items[ndx:ndx + size] for ndx in range(0, len(items), size)]
+
+
+# Run the download jobs, each of which is a function and the batch of replicate
+# ids and filenames that it should download. When more than one worker is 
+# requested a pool is used to keep that many queries in-flight at once, with 
+# each result written as it arrives. The summaries of the replicates are 
+# recorded in the manifest for the directory every MANIFEST_INTERVAL replicates
+# and returned in the order they completed.
+def download(jobs, total, workers, replicates):
+  endtimes = {row[3]: str(row[5]) for row in replicates}
+  manifests = {}
+  downloads = sum([len(batch) for function, batch in jobs])
+  count, results = total - downloads, []
+  start = time.time()
+  progressBar(count, total)
+
+  # Note the summaries of the replicates and periodically save the manifest
+  def record(summaries):
+    for summary in summaries:
+      summary['endtime'] = endtimes.get(summary['replicateid'], '')
+      if summary['directory'] not in manifests:
+        manifests[summary['directory']] = load_manifest(summary['directory'])
+      manifests[summary['directory']][summary['replicateid']] = summary
+    results.extend(summaries)
+    if len(results) // MANIFEST_INTERVAL != (len(results) - len(summaries)) // MANIFEST_INTERVAL:
+      save(manifests)
+
+  # Save each of the manifests that have been updated
+  def save(manifests):
+    for directory in manifests:
+      save_manifest(directory, manifests[directory], MANIFEST_FIELDS)
+
+  if workers <= 1:
+    for function, batch in jobs:
+      record(function(batch))
+      count = count + len(batch)
+      progressBar(count, total)
+  else:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      futures = {executor.submit(function, batch): len(batch) for function, batch in jobs}
+      for future in concurrent.futures.as_completed(futures):
+        record(future.result())
+        count = count + futures[future]
+        progressBar(count, total)
+  save(manifests)
+
+  # Report the throughput if anything was downloaded
+  elapsed = time.time() - start
+  if downloads > 0:
+    print("Downloaded {} replicates in {:.1f}s ({:.2f} replicates/s)".format(downloads, elapsed, downloads / max(elapsed, 1e-6)))
+  return results
+
+
+# Query and store the genotype data for the batch of replicates
+def download_genotype(batch):
+  return extract(GENOTYPE_SQL, batch, genotype=True)
+
+
+# Query and store the district data for the batch of replicates
+def download_replicate(batch):
+  return extract(REPLICATE_SQL, batch)
+
+
+# Query and store the district data for the batch of replicates that have 
+# therapy records, the summaries note that the therapy records table was used
+def download_replicate_tr(batch):
+  summaries = extract(REPLICATE_TR_SQL, batch)
+  for summary in summaries: summary['therapy'] = True
+  return summaries
+
+
+# Extract the batch of replicates using a single query, the rows are streamed
+# back ordered by the replicate id and split apart on the client so each 
+# replicate is written once all of its rows arrive. Returns the summary of each
+# replicate for the manifest.
+def extract(sql, batch, genotype=False):
+  if len(batch) == 0: return []
+  if COPY: return extract_copy(sql, batch, genotype)
+  filenames, summaries = dict(batch), []
+  rows = stream(sql, {'replicateIds': list(filenames.keys())})
+  column = 0 if genotype else 1
+  for replicateId, replicate in itertools.groupby(rows, key=lambda row: row[column]):
+    filename = filenames.pop(replicateId)
+    data = save_dataset(filename, list(replicate))
+    summaries.append(summarize(replicateId, filename, data, genotype))
+
+  # Replicates without any rows still get a file, as with a single query
+  for replicateId, filename in filenames.items():
+    data = save_dataset(filename, [])
+    summaries.append(summarize(replicateId, filename, data, genotype))
+  return summaries
+
+
+# Extract the batch of replicates using COPY, the CSV produced by the database 
+# is written to a temporary file that is then split by replicate line by line, 
+# or moved into place if there is only one replicate. Returns the summary of 
+# each replicate for the manifest.
+def extract_copy(sql, batch, genotype=False):
+  filenames, summaries = dict(batch), []
+  temp = batch[0][1] + '.copy'
+  copy(sql, {'replicateIds': list(filenames.keys())}, temp)
+
+  # Split the output by replicate, the id is the first or second field
+  column = 0 if genotype else 1
+  if len(batch) == 1:
+    os.replace(temp, batch[0][1] + '.tmp')
+  else:
+    with open(temp, 'r') as infile:
+      for replicateId, lines in itertools.groupby(infile, key=lambda line: int(line.split(',', 2)[column])):
+        with open(filenames[replicateId] + '.tmp', 'w') as outfile:
+          outfile.writelines(lines)
+    os.remove(temp)
+
+  # Save each of the replicates, those without any rows still get a file
+  for replicateId, filename in batch:
+    if not os.path.exists(filename + '.tmp'): 
+      open(filename + '.tmp', 'w').close()
+    data = save_copy(filename, filename + '.tmp')
+    summaries.append(summarize(replicateId, filename, data, genotype))
+  return summaries
+
+
+# Query and store the district and genotype data for the batch of replicates, 
+# each item in the batch is the replicate id, the district data filename, and
+# the genotype data filename, or None if it is not needed
+def download_unified(batch):
+  return extract_unified(UNIFIED_SQL, batch)
+
+
+# Query and store the district and genotype data for the batch of replicates 
+# that have therapy records, the district data uses the therapy records table
+def download_unified_tr(batch):
+  return extract_unified(UNIFIED_TR_SQL, batch, therapy=True)
+
+
+# Extract the batch of replicates using the unified query, the rows for each
+# replicate are split into the district and genotype data sets locally and each
+# is written once all of the rows for the replicate arrive
+def extract_unified(sql, batch, therapy=False):
+  if len(batch) == 0: return []
+  filenames, summaries = {item[0]: item[1:] for item in batch}, []
+  rows = stream(sql, {'replicateIds': list(filenames.keys())})
+  for replicateId, replicate in itertools.groupby(rows, key=lambda row: row[1]):
+    summaries.extend(save_unified(replicateId, list(replicate), filenames.pop(replicateId), therapy))
+
+  # Replicates without any rows still get files, as with a single query
+  for replicateId, files in filenames.items():
+    summaries.extend(save_unified(replicateId, [], files, therapy))
+  return summaries
+
+
+# Split the unified rows for the replicate into the district and genotype data 
+# sets and save them, returns the summaries of the data sets written
+def save_unified(replicateId, rows, files, therapy):
+  district, genotype = split_unified(rows, therapy)
+  summaries = [summarize(replicateId, files[0], save_dataset(files[0], district), False)]
+  summaries[0]['therapy'] = therapy
+  if files[1] is not None:
+    summaries.append(summarize(replicateId, files[1], save_dataset(files[1], genotype), True))
+  return summaries
+
+
+# Derive the rows of the district and genotype data sets from the unified rows,
+# these match the rows returned by REPLICATE_SQL (or REPLICATE_TR_SQL) and by 
+# GENOTYPE_SQL respectively
+def split_unified(rows, therapy):
+  CONFIGURATION, REPLICATE, DATES, DISTRICT, POPULATION, WEIGHTED_PFPR = 0, 1, 2, 3, 4, 5
+  INFECTED, CLINICAL, TREATMENTS, FAILURES, CARRIERS, TR_TREATMENTS, TR_FAILURES, GENOMES = 6, 7, 8, 9, 10, 11, 12, 13
+  OCCURRENCES_561H, OCCURRENCES_PLASMEPSIN, OCCURRENCES_DOUBLE = 14, 17, 20
+
+  def value(entry):
+    return 0 if entry is None else entry
+
+  district, genotype, national = [], [], {}
+  for row in rows:
+    treatments = (row[TR_TREATMENTS], row[TR_FAILURES]) if therapy else (row[TREATMENTS], row[FAILURES])
+    district.append([row[CONFIGURATION], row[REPLICATE], row[DATES], row[DISTRICT], row[INFECTED], row[CLINICAL]] + 
+                    [value(entry) for entry in row[OCCURRENCES_561H:OCCURRENCES_561H + 3]] + 
+                    [treatments[0], treatments[1], row[CARRIERS]])
+
+    # Sum the district values to get the national values for the date
+    if row[DATES] not in national: 
+      national[row[DATES]] = [0] * (len(row) - POPULATION)
+    totals = national[row[DATES]]
+    for ndx in range(POPULATION, len(row)):
+      if ndx in [TR_TREATMENTS, TR_FAILURES]: continue
+      totals[ndx - POPULATION] += value(row[ndx])
+
+  # Dates without any genome data are dropped, the PfPR is rounded as the 
+  # database would round it
+  for date in sorted(national.keys()):
+    totals = [None] * POPULATION + national[date]
+    if totals[GENOMES] == 0: continue
+    pfpr = decimal.Decimal('%.15g' % (totals[WEIGHTED_PFPR] / totals[POPULATION])) if totals[POPULATION] > 0 else decimal.Decimal(0)
+    pfpr = pfpr.quantize(decimal.Decimal('0.001'), rounding=decimal.ROUND_HALF_UP)
+    genotype.append([rows[0][REPLICATE], date, totals[POPULATION], totals[INFECTED], totals[CLINICAL], totals[TREATMENTS], totals[FAILURES], pfpr] + 
+                    totals[OCCURRENCES_561H:OCCURRENCES_561H + 3] + totals[OCCURRENCES_PLASMEPSIN:OCCURRENCES_PLASMEPSIN + 3] + 
+                    totals[OCCURRENCES_DOUBLE:OCCURRENCES_DOUBLE + 3])
+  return district, genotype
+
+
+# Summarize the replicate data for the manifest, this includes a checksum of the
+# data as written and the 561H frequency 
+# in the reference district on the reference date that is used to validate the
+# replicate, which does not apply to the national genotype data.
+def summarize(replicateId, filename, data, genotype):
+  DATES, DISTRICT, INDIVIDUALS, WEIGHTED = rwa_schema.DISTRICT.indices('dates', 'district', 'infections', 'weighted')
+  if genotype: DATES = rwa_schema.GENOTYPE.index('dates')
+
+  checksum = hashlib.sha1(pd.util.hash_pandas_object(data, index=False).values.tobytes()).hexdigest()
+  summary = {'replicateid': replicateId, 'rows': len(data), 'checksum': checksum, 'endtime': '', 'first': '', 'last': '', 
+             'reference': '', 'therapy': False, 'directory': os.path.dirname(filename)}
+  if len(data) == 0: return summary
+  summary['first'], summary['last'] = data[DATES].min(), data[DATES].max()
+  if genotype: return summary
+
+  # Find the reference frequency, this may not be present for short replicates
+  reference = (rwanda.REFERENCEDATE - datetime.datetime.strptime(rwanda.STUDYDATE, "%Y-%m-%d")).days
+  temp = data[(data[DATES] == reference) & (data[DISTRICT] == rwanda.REFERENCEDISTRICT)]
+  if len(temp) > 0:
+    summary['reference'] = (temp[WEIGHTED] / temp[INDIVIDUALS]).values[0]
+  return summary
+
+
+# Return the path of the manifest for the directory
+def manifest_path(directory):
+  return os.path.normpath(directory) + '-manifest.csv'
+
+
+# Load the manifest for the directory, keyed by the replicate id by default
+def load_manifest(directory, key='replicateid'):
+  manifest = {}
+  if os.path.exists(manifest_path(directory)):
+    with open(manifest_path(directory), 'r') as csvfile:
+      for row in csv.DictReader(csvfile):
+        manifest[int(row[key]) if key == 'replicateid' else row[key]] = row
+  return manifest
+
+
+# Save the manifest for the directory, this is written to a temporary file 
+# first so an interrupted run always leaves the previous manifest intact
+def save_manifest(directory, manifest, fields):
+  temp = manifest_path(directory) + '.tmp'
+  with open(temp, 'w') as csvfile:
+    writer = csv.DictWriter(csvfile, fieldnames=fields, extrasaction='ignore')
+    writer.writeheader()
+    for entry in sorted(manifest.keys()):
+      writer.writerow(manifest[entry])
+  os.replace(temp, manifest_path(directory))
+
+
+# Run the query against the local mirror when one is set, otherwise against the
+# database, returning all of the rows
+def query(sql, parameters):
+  if MIRROR is not None:
+    return mirror.select(MIRROR, sql, parameters)
+  return select(CONNECTION, sql, parameters)
+
+
+# Run the query using a server-side cursor so the rows are streamed back in
+# blocks of ITERSIZE rows as opposed to holding the full result set in memory
+def stream(sql, parameters):
+  if MIRROR is not None:
+    yield from mirror.stream(MIRROR, sql, parameters)
+    return
+  connection = psycopg2.connect(CONNECTION)
+  try:
+    with connection.cursor(name='replicates') as cursor:
+      cursor.itersize = ITERSIZE
+      cursor.execute(sql, parameters)
+      for row in cursor:
+        yield row
+  finally:
+    connection.close()
+
+
+# Run the query using COPY and write the CSV produced by the database directly
+# to the file given
+def copy(sql, parameters, filename):
+  connection = psycopg2.connect(CONNECTION)
+  try:
+    with connection.cursor() as cursor, open(filename, 'w') as csvfile:
+      statement = cursor.mogrify(sql, parameters).decode('utf-8')
+      cursor.copy_expert('COPY ({}) TO STDOUT WITH (FORMAT csv)'.format(statement), csvfile)
+  finally:
+    connection.close()
+
+
+# Save the replicate from the CSV file written by COPY in the format requested,
+# returns the rows as a data frame
+def save_copy(filename, temp):
+  data = pd.read_csv(temp, header=None) if os.path.getsize(temp) > 0 else pd.DataFrame()
+  if FORMAT in ['csv', 'both']:
+    os.replace(temp, filename)
+  else:
+    os.remove(temp)
+  if FORMAT in ['columnar', 'both']:
+    rwanda.write_dataset(filename, data, 'columnar')
+  return data
+
+
+# Save the replicate rows returned by the database in the format requested,
+# returns the rows as a data frame
+def save_dataset(filename, rows):
+  data = pd.DataFrame(rows).apply(pd.to_numeric)
+  if FORMAT in ['csv', 'both']:
+    save_csv(filename, rows)
+  if FORMAT in ['columnar', 'both']:
+    rwanda.write_dataset(filename, data, 'columnar')
+  return data
+
+
+# Save the rows to the CSV file, this is written to a temporary file first so a
+# partially written file is never left in place. Lines end with \n to match the
+# CSV files written by pandas and the database so they can be merged directly.
 def save_csv(filename, data):
-  with open(filename, 'w') as csvfile:
-    writer = csv.writer(csvfile)
+  with open(filename + '.tmp', 'w') as csvfile:
+    writer = csv.writer(csvfile, lineterminator='\n')
     for row in data:
       writer.writerow(row)
+  os.replace(filename + '.tmp', filename)
 
 
 def main(args):
@@ -417,23 +984,46 @@ def main(args):
   # relevant replicates to the side as the data set for plotting. Since the 
   # project is iterating quickly this will save on needing to clean-up the 
   # database.
-  process_replicates(args.filter_date, int(args.study_id))
+  if args.unified:
+    if not os.path.exists(GENOTYPE_DATASET): os.makedirs(GENOTYPE_DATASET)
+    if not os.path.exists(GENOTYPE_DIRECTORY): os.makedirs(GENOTYPE_DIRECTORY)
+    finalize = process_unified(args.filter_date, int(args.study_id), int(args.workers), int(args.batch_size))
+  else:
+    process_replicates(args.filter_date, int(args.study_id), int(args.workers), int(args.batch_size))
 
   if args.manuscript: 
-    process_final_datasets(args.filter_date, REPLICATE_DIRECTORY, DATASET_DIRECTORY, int(args.count))
+    process_final_datasets(args.filter_date, REPLICATE_DIRECTORY, DATASET_DIRECTORY, int(args.count), int(args.workers))
   else:
-    process_datasets()
+    process_datasets(int(args.workers))
+
+  # The genotype data was downloaded along with the district data so it only
+  # needs to be finalized if there was anything new
+  if args.unified and finalize:
+    process_final_datasets(args.filter_date, GENOTYPE_DIRECTORY, GENOTYPE_DATASET, int(args.count), int(args.workers))
 
 
 if __name__ == '__main__':
   # Parse the arguments
   parser = argparse.ArgumentParser()
+  parser.add_argument('-b', action='store', dest='batch_size', default=BATCH_SIZE, help='The number of replicates to extract per query, default {}'.format(BATCH_SIZE))
   parser.add_argument('-c', action='store', dest='count', default=REPLICATE_COUNT, help='The number of replicates to include in a dataset, default {}'.format(REPLICATE_COUNT))
   parser.add_argument('-d', action='store', dest='filter_date', default='2022-09-01', help='The date to filter the replicates on')
+  parser.add_argument('-f', action='store', dest='format', default=FORMAT, choices=rwanda.DATASET_FORMATS, help='The format to store the replicates and data sets in, default {}'.format(FORMAT))
   parser.add_argument('-m', action='store_true', dest='manuscript', help='Flag to select the manuscript dataset processing type')
   parser.add_argument('-s', action='store', dest='study_id', required=True, help='The id of the study to get the replicates for')
+  parser.add_argument('-u', action='store_true', dest='unified', help='Flag to extract the district and genotype data with a single query per replicate')
+  parser.add_argument('-w', action='store', dest='workers', default=WORKERS, help='The number of replicates to download, or data sets to merge, concurrently, default {}'.format(WORKERS))
+  parser.add_argument('--connection', action='store', dest='connection', default=CONNECTION, help='The connection string for the database, e.g., to use a local copy of the database')
+  parser.add_argument('--copy', action='store_true', dest='copy', help='Flag to extract the replicates using COPY as opposed to returning the rows')
+  parser.add_argument('--mirror', action='store', dest='mirror', default=None, help='The path of a local mirror of the database to use in place of the database')
   args = parser.parse_args()
+  if args.copy and (args.unified or args.mirror is not None):
+    parser.error('--copy cannot be used with -u or --mirror')
+  FORMAT, CONNECTION, COPY = args.format, args.connection, args.copy
+  if args.mirror is not None:
+    MIRROR = args.mirror
   
   print("Filter: {}, Study: {}".format(args.filter_date, args.study_id))
   main(args)
-  process_genotype(args.filter_date, args.study_id, args.count)
+  if not args.unified:
+    process_genotype(args.filter_date, args.study_id, int(args.count), int(args.workers), int(args.batch_size))
@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+
+# mirror.py
+#
+# Mirror the replicates for the studies given from the database to a local
+# SQLite database so that they can be analyzed, or extracted again, offline.
+#
+# == NOTES ==
+# The mirror is incremental, replicates are only copied if they are not present
+# in the mirror or their end time has changed. A replicate is only recorded in
+# the mirror once all of its data has been copied, so an interrupted sync will
+# pick the replicate up again on the next run.
+#
+# The queries written against the database can be run against the mirror using
+# the select and stream functions. These translate the PostgreSQL specific parts
+# of the queries used in this repository (e.g., ANY, ~, to_date) to SQLite.
+import argparse
+import datetime
+import decimal
+import os
+import psycopg2
+import re
+import sqlite3
+import sys
+
+# From the PSU-CIDD-MaSim-Support repository
+sys.path.insert(1, '../../PSU-CIDD-MaSim-Support/Python/include')
+from utility import progressBar
+
+# Connection string for the database
+CONNECTION = 'host=masimdb.vmhost.psu.edu dbname=rwanda user=sim password=sim connect_timeout=60'
+
+# Path for the local mirror of the database
+MIRROR = 'data/mirror.sqlite'
+
+# The number of rows to fetch per round trip when copying the replicates
+ITERSIZE = 10000
+
+# The SQLite column types to use for the PostgreSQL type OIDs, anything not
+# listed is stored as text
+TYPES = { 16: 'INTEGER', 20: 'INTEGER', 21: 'INTEGER', 23: 'INTEGER',
+          700: 'REAL', 701: 'REAL', 1700: 'REAL',
+          1082: 'DATE', 1114: 'TIMESTAMP', 1184: 'TIMESTAMP' }
+
+# The tables that are copied for each replicate, along with the query for the
+# rows and the column to index on. The rows are deleted in reverse order when a
+# replicate needs to be copied again.
+TABLES = [
+  ('monthlydata', 'replicateid', """
+      SELECT md.* FROM sim.monthlydata md
+      WHERE md.replicateid = %(replicateId)s"""),
+  ('monthlysitedata', 'monthlydataid', """
+      SELECT msd.* FROM sim.monthlysitedata msd
+        INNER JOIN sim.monthlydata md ON md.id = msd.monthlydataid
+      WHERE md.replicateid = %(replicateId)s"""),
+  ('monthlygenomedata', 'monthlydataid', """
+      SELECT mgd.* FROM sim.monthlygenomedata mgd
+        INNER JOIN sim.monthlydata md ON md.id = mgd.monthlydataid
+      WHERE md.replicateid = %(replicateId)s"""),
+  ('therapyrecord', 'monthlydataid', """
+      SELECT tr.* FROM sim.therapyrecord tr
+        INNER JOIN sim.monthlydata md ON md.id = tr.monthlydataid
+      WHERE md.replicateid = %(replicateId)s""")]
+
+# The view of the therapy records used by the loader, in the database this is
+# public.v_therapyrecords
+THERAPY_VIEW = """
+      CREATE VIEW IF NOT EXISTS v_therapyrecords AS
+      SELECT md.replicateid, tr.* FROM therapyrecord tr
+        INNER JOIN monthlydata md ON md.id = tr.monthlydataid"""
+
+
+# Values returned by psycopg2 that SQLite does not know how to store
+sqlite3.register_adapter(decimal.Decimal, float)
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(' '))
+sqlite3.register_adapter(datetime.date, lambda value: value.isoformat())
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.datetime.fromisoformat(value.decode()))
+sqlite3.register_converter('DATE', lambda value: datetime.date.fromisoformat(value.decode()))
+
+
+def get_configurations(connection, studyIds):
+  sql = """
+      SELECT c.* FROM sim.configuration c
+      WHERE c.studyid = ANY(%(studyIds)s)"""
+  return fetch(connection, sql, {'studyIds': studyIds})
+
+
+def get_genotypes(connection):
+  return fetch(connection, "SELECT g.* FROM sim.genotype g", None)
+
+
+def get_replicates(connection, studyIds):
+  sql = """
+      SELECT r.* FROM sim.replicate r
+        INNER JOIN sim.configuration c ON c.id = r.configurationid
+      WHERE c.studyid = ANY(%(studyIds)s)
+        AND r.endtime IS NOT NULL
+      ORDER BY r.id"""
+  return fetch(connection, sql, {'studyIds': studyIds})
+
+
+# Run the query against the database and return the column description along
+# with the rows
+def fetch(connection, sql, parameters):
+  with connection.cursor() as cursor:
+    cursor.execute(sql, parameters)
+    return cursor.description, cursor.fetchall()
+
+
+# Create the table in the mirror using the column description from the
+# database, when there is an id column it is used as the primary key
+def create_table(mirror, table, description, index=None):
+  columns = []
+  for column in description:
+    columns.append('{} {}{}'.format(column.name, TYPES.get(column.type_code, 'TEXT'), ' PRIMARY KEY' if column.name == 'id' else ''))
+  mirror.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(table, ', '.join(columns)))
+  if index is not None:
+    mirror.execute('CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})'.format(table, index))
+
+
+# Insert or replace the rows in the table of the mirror
+def insert(mirror, table, rows):
+  if len(rows) == 0: return
+  sql = 'INSERT OR REPLACE INTO {} VALUES ({})'.format(table, ', '.join(['?'] * len(rows[0])))
+  mirror.executemany(sql, rows)
+
+
+# Copy the data for the replicate from the database to the mirror, any rows
+# already present for the replicate are deleted first. The replicate itself is
+# added last and all of the changes are committed as a single transaction.
+def copy_replicate(connection, mirror, replicate, columns):
+  replicateId = replicate[columns.index('id')]
+  with mirror:
+    for table, index, sql in reversed(TABLES):
+      if table == 'monthlydata':
+        mirror.execute('DELETE FROM monthlydata WHERE replicateid = ?', (replicateId, ))
+      else:
+        mirror.execute('DELETE FROM {} WHERE monthlydataid IN (SELECT id FROM monthlydata WHERE replicateid = ?)'.format(table), (replicateId, ))
+    for table, index, sql in TABLES:
+      with connection.cursor(name='mirror') as cursor:
+        cursor.itersize = ITERSIZE
+        cursor.execute(sql, {'replicateId': replicateId})
+        while True:
+          rows = cursor.fetchmany(ITERSIZE)
+          if len(rows) == 0: break
+          insert(mirror, table, rows)
+    insert(mirror, 'replicate', [replicate])
+
+
+# Mirror the replicates for the studies from the database
+def sync(studyIds, path=MIRROR):
+  if os.path.dirname(path) != '' and not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+  connection = psycopg2.connect(CONNECTION)
+  mirror = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+  try:
+    # Prepare the tables, using an empty query to get the columns
+    for table, index, sql in [('configuration', 'studyid', None), ('genotype', None, None), ('replicate', 'configurationid', None)] + TABLES:
+      description, rows = fetch(connection, 'SELECT * FROM sim.{} LIMIT 0'.format(table), None)
+      create_table(mirror, table, description, index)
+    mirror.execute(THERAPY_VIEW)
+
+    # Update the configurations and genotypes, these are small enough to copy
+    print("Updating configurations and genotypes...")
+    with mirror:
+      insert(mirror, 'configuration', get_configurations(connection, studyIds)[1])
+      insert(mirror, 'genotype', get_genotypes(connection)[1])
+
+    # Find the replicates that are not present in the mirror, or have changed
+    print("Querying for replicates list...")
+    description, replicates = get_replicates(connection, studyIds)
+    columns = [column.name for column in description]
+    present = dict(mirror.execute('SELECT id, endtime FROM replicate').fetchall())
+    pending = [row for row in replicates if present.get(row[columns.index('id')]) != row[columns.index('endtime')]]
+
+    # Copy the replicates
+    print("Copying {} of {} replicates...".format(len(pending), len(replicates)))
+    for count, replicate in enumerate(pending):
+      progressBar(count, len(pending))
+      copy_replicate(connection, mirror, replicate, columns)
+    progressBar(len(pending), len(pending))
+  finally:
+    connection.close()
+    mirror.close()
+
+
+# Used by SQLite for the REGEXP operator, which replaces the ~ operator
+def regexp(pattern, value):
+  return value is not None and re.search(pattern, value) is not None
+
+
+# Translate the PostgreSQL query and parameters to run against the mirror,
+# returns the SQLite query and parameters
+def translate(sql, parameters):
+  parameters = parameters if parameters is not None else {}
+  values = {}
+
+  # Lists used with ANY are expanded in to an IN with a parameter per entry
+  def expand(match):
+    names = []
+    for ndx, value in enumerate(parameters[match.group(1)]):
+      names.append('{}_{}'.format(match.group(1), ndx))
+      values[names[-1]] = value
+    return 'IN ({})'.format(', '.join([':' + name for name in names]) if len(names) > 0 else 'NULL')
+  sql = re.sub(r'=\s*ANY\(%\((\w+)\)s\)', expand, sql, flags=re.IGNORECASE)
+  for key, value in parameters.items():
+    if not isinstance(value, (list, tuple)): values[key] = value
+
+  # Named parameters, the schema, and the functions and operators that differ
+  sql = re.sub(r'%\((\w+)\)s', r':\1', sql)
+  sql = re.sub(r'\b(sim|public)\.', '', sql)
+  sql = re.sub(r"TO_CHAR\(TO_DATE\(('[^']*'), 'YYYY-MM-DD'\) \+ interval '1' day \* ([\w.]+), 'YYYY'\)",
+               r"strftime('%Y', date(\1, '+' || \2 || ' days'))", sql, flags=re.IGNORECASE)
+  sql = re.sub(r"to_date\(([^,]+), 'YYYY-MM-DD'\)", r'date(\1)', sql, flags=re.IGNORECASE)
+  sql = re.sub(r'\bas\s+(decimal|numeric)\)', 'AS REAL)', sql, flags=re.IGNORECASE)
+  sql = re.sub(r'\bsubstring\(', 'substr(', sql, flags=re.IGNORECASE)
+  sql = re.sub(r'\s~\s', ' REGEXP ', sql)
+
+  # Values from numpy (e.g., replicate ids from a data frame) need to be unwrapped
+  return sql, {key: value.item() if hasattr(value, 'item') else value for key, value in values.items()}
+
+
+# Open the mirror for queries
+def connect(path):
+  connection = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+  connection.create_function('regexp', 2, regexp, deterministic=True)
+  return connection
+
+
+# Run the query against the mirror, this is a replacement for database.select
+def select(path, sql, parameters):
+  connection = connect(path)
+  try:
+    return connection.execute(*translate(sql, parameters)).fetchall()
+  finally:
+    connection.close()
+
+
+# Run the query against the mirror returning the rows as they are read
+def stream(path, sql, parameters):
+  connection = connect(path)
+  try:
+    for row in connection.execute(*translate(sql, parameters)):
+      yield row
+  finally:
+    connection.close()
+
+
+if __name__ == '__main__':
+  # Parse the arguments
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-f', action='store', dest='filename', default=MIRROR, help='The path of the mirror, default {}'.format(MIRROR))
+  parser.add_argument('-s', action='append', dest='study_ids', required=True, help='The id of a study to mirror, may be repeated')
+  args = parser.parse_args()
+
+  sync([int(studyId) for studyId in args.study_ids], args.filename)
@@ -40,9 +40,7 @@ def add_spikes(plot):
 
 def plot_data(data, dates, ax):
     # Find the bounds of the data
-    upper = np.percentile(data, 97.5, axis=0)
-    median = np.percentile(data, 50, axis=0)
-    lower = np.percentile(data, 2.5, axis=0)
+    lower, median, upper = rwanda.as_bands(data, rwanda.CI95)
 
     # Add the data to the subplot
     ax.plot(dates, median)
@@ -59,8 +57,9 @@ def plot():
     # Parse the data and add it to the plot
     for row in range(len(PLOTS)):
         for col in range(len(PLOTS[row])):
-            # Load the data
-            dates, frequencies = rwanda.prepare_validation(PATH.format(PLOTS[row][col]))
+            # Load the national bands from the band store of the cube
+            cube = rwanda.open_cube(PATH.format(PLOTS[row][col]))
+            dates, frequencies = cube.dates.tolist(), cube.band('frequency', quantiles=rwanda.CI95)
             
             # Format the dates
             startDate = datetime.datetime.strptime(rwanda.STUDYDATE, "%Y-%m-%d")
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# rwa_cache.py
+#
+# Cache for the parsed datasets used by the plotting scripts.
+#
+# Entries are keyed by a hash of the input files (name, size, and modification
+# time) along with the parameters that the results depend upon, so any change
+# to either results in a new key and stale entries are never read. Entries are
+# stored as .npz files of typed arrays so they can be loaded without pickle and
+# the least recently used entries are evicted when the cache is over budget.
+import hashlib
+import numpy as np
+import os
+import zipfile
+
+# The directory for the cache entries
+CACHE_DIRECTORY = 'np/cache'
+
+# The size budget for the cache in bytes
+CACHE_BUDGET = 2 * 1024 ** 3
+
+# Separator used when flattening the keys of nested dictionaries
+SEPARATOR = '|'
+
+
+# Return the key for the input files and parameters given, the files may be
+# directories (e.g., columnar datasets) and missing files are ignored
+def key(filenames, **parameters):
+    digest = hashlib.sha1()
+    for filename in sorted(filenames):
+        for path in files(filename):
+            stat = os.stat(path)
+            name = os.path.relpath(path, os.path.dirname(filename))
+            digest.update('{}:{}:{}\n'.format(name, stat.st_size, stat.st_mtime_ns).encode())
+    for name in sorted(parameters):
+        digest.update('{}={!r}\n'.format(name, parameters[name]).encode())
+    return digest.hexdigest()
+
+
+# Return the files that make up the path given
+def files(path):
+    if os.path.isdir(path):
+        return sorted([os.path.join(path, name) for name in os.listdir(path)])
+    return [path] if os.path.exists(path) else []
+
+
+# Return the path of the cache entry for the key, the directory defaults to the
+# CACHE_DIRECTORY for this and the functions below
+def entry_path(key, directory=None):
+    return os.path.join(CACHE_DIRECTORY if directory is None else directory, '{}.npz'.format(key))
+
+
+# Load the cache entry for the key, returns None if there isn't one
+def load(key, directory=None):
+    path = entry_path(key, directory)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            values = {name: data[name] for name in data.files}
+    except (OSError, ValueError, zipfile.BadZipFile):
+        os.remove(path)
+        return None
+
+    # Note the use of the entry for the eviction order
+    os.utime(path)
+    return unflatten(values)
+
+
+# Save the values, which may be nested dictionaries of arrays, as the cache
+# entry for the key and then evict any entries that are over the budget
+def save(key, values, directory=None):
+    directory = CACHE_DIRECTORY if directory is None else directory
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    path = entry_path(key, directory)
+    temp = path + '.tmp'
+    with open(temp, 'wb') as out:
+        np.savez(out, **flatten(values))
+    os.replace(temp, path)
+    evict(directory=directory)
+
+
+# Remove the least recently used entries until the cache is within the budget,
+# the most recent entry is always kept
+def evict(budget=None, directory=None):
+    budget = CACHE_BUDGET if budget is None else budget
+    directory = CACHE_DIRECTORY if directory is None else directory
+    entries = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.npz')]
+    entries.sort(key=os.path.getmtime)
+    total = sum([os.path.getsize(entry) for entry in entries])
+    while total > budget and len(entries) > 1:
+        total -= os.path.getsize(entries[0])
+        os.remove(entries.pop(0))
+
+
+# Flatten the nested dictionaries to a single dictionary of typed arrays
+def flatten(values, prefix=''):
+    results = {}
+    for name, value in values.items():
+        if isinstance(value, dict):
+            results.update(flatten(value, prefix + name + SEPARATOR))
+            continue
+        value = np.asarray(value)
+        if value.dtype == object:
+            raise ValueError('Unable to cache {}, the values are not a typed array'.format(prefix + name))
+        results[prefix + name] = value
+    return results
+
+
+# Restore the nested dictionaries from the flattened dictionary
+def unflatten(values):
+    results = {}
+    for name, value in values.items():
+        keys = name.split(SEPARATOR)
+        current = results
+        for key in keys[:-1]:
+            current = current.setdefault(key, {})
+        current[keys[-1]] = value
+    return results
@@ -11,14 +11,13 @@ import math
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import sys
 
 import rwanda
+import rwa_schema
 
 sys.path.insert(1, '../../PSU-CIDD-MaSim-Support/Python/include')
 from plotting import increment, scale_luminosity
-from utility import progressBar
 
 
 def box_plot(path, plot_type, offset = 0):
@@ -38,9 +37,12 @@ def box_plot(path, plot_type, offset = 0):
   else:
     sys.exit('Unknown box plot type, {}'.format(plot_type))
   
+  # Load the data for each of the cycling periods, in parallel if requested
+  periods = [90, 180, 270, 365, 545, 730]
+  parsed = rwanda.process(load, [('../Analysis/data/{}/rwa-cycling-{}.csv'.format(path, days), plot_type) for days in periods])
+
   row, col = 0, 0
-  for days in [90, 180, 270, 365, 545, 730]:
-    dates, replicates = load('../Analysis/data/{}/rwa-cycling-{}.csv'.format(path, days), plot_type)
+  for days, (dates, replicates) in zip(periods, parsed):
     dates = [startDate + datetime.timedelta(days=x) for x in dates]
     
     # Parse the data into something the box plot can work with
@@ -75,52 +77,36 @@ def box_plot(path, plot_type, offset = 0):
 
 def load(filename, plot_type):
   if plot_type in ['frequency', 'failures', 'ntf']:
-    REPLICATE, DATES, INFECTIONS, WEIGHTED, TREATMENTS, TREATMENT_FAILURES = 1, 2, 4, 8, 9, 10
+    REPLICATE, DATES, INFECTIONS, WEIGHTED, TREATMENTS, TREATMENT_FAILURES = rwa_schema.DISTRICT.indices(
+      'replicate', 'dates', 'infections', 'weighted', 'treatments', 'failures')
   elif plot_type in ['double', 'pfpr', 'ppq']:
-    REPLICATE, DATES, PFPR, INFECTIONS, WEIGHTED, DOUBLE_WEIGHTED = 0, 1, 7, 3, 13, 16
-  
-  # Load the data, calculate the frequency; note the unique dates, replicates
-  data = pd.read_csv(filename, header = None)
-  dates = data[DATES].unique().tolist()
-  replicates = data[REPLICATE].unique().tolist()
-  
-  # Load the frequency from the data set
-  count, plot_data = 0, []
-  for replicate in replicates:
-    byReplicate = data[data[REPLICATE] == replicate]
-    
-    # Genotype data is already aggregated nationally
-    if plot_type == 'pfpr': temp = byReplicate[PFPR]
-    elif plot_type == 'ppq': temp = byReplicate[WEIGHTED] / byReplicate[INFECTIONS]
-    elif plot_type == 'double': temp = byReplicate[DOUBLE_WEIGHTED] / byReplicate[INFECTIONS]
-    
-    # Otherwise the district data needs to be aggregated
-    else:
-      temp = []
-      for date in dates:
-        byDate = byReplicate[byReplicate[DATES] == date]
-        if plot_type == 'frequency': temp.append(sum(byDate[WEIGHTED]) / sum(byDate[INFECTIONS]))
-        elif plot_type == 'failures': temp.append(sum(byDate[TREATMENT_FAILURES]) / sum(byDate[TREATMENTS]))
-        elif plot_type == 'ntf': temp.append(sum(byDate[TREATMENT_FAILURES]))
-    
-    # Update the data to be returned
-    if len(plot_data) != 0: plot_data = np.vstack((plot_data, temp))
-    else: plot_data = temp
+    REPLICATE, DATES, PFPR, INFECTIONS, WEIGHTED, DOUBLE_WEIGHTED = rwa_schema.GENOTYPE.indices(
+      'replicate', 'dates', 'pfpr', 'infections', 'weighted_plasmepsin', 'weighted_double')
   
-    # Update the progress bar
-    count += 1
-    progressBar(count, len(replicates))
-  
-  # Return the results
-  return dates, plot_data 
+  # Load the data and aggregate it by replicate and date, note that the genotype
+  # data is already aggregated nationally so there is one row for each
+  if plot_type in ['frequency', 'failures', 'ntf']:
+    columns = {'infections': INFECTIONS, 'weighted': WEIGHTED, 'treatments': TREATMENTS, 'failures': TREATMENT_FAILURES}
+  else:
+    columns = {'pfpr': PFPR, 'infections': INFECTIONS, 'weighted': WEIGHTED, 'double': DOUBLE_WEIGHTED}
+  data = rwanda.read_dataset(filename, [REPLICATE, DATES] + list(columns.values()))
+  replicates, dates, values = rwanda.aggregate(data, columns, REPLICATE, DATES)
+
+  # Calculate the values to be returned
+  if plot_type == 'pfpr': plot_data = values['pfpr']
+  elif plot_type in ['ppq', 'frequency']: plot_data = rwanda.ratio(values['weighted'], values['infections'])
+  elif plot_type == 'double': plot_data = rwanda.ratio(values['double'], values['infections'])
+  elif plot_type == 'failures': plot_data = rwanda.ratio(values['failures'], values['treatments'])
+  elif plot_type == 'ntf': plot_data = values['failures']
+  return dates.tolist(), plot_data 
 
 
 def metrics():
   def load_data(filename, offset):
-    REPLICATE, DATES, POPULATION, FAILURES = 0, 1, 2, 6
+    REPLICATE, DATES, POPULATION, FAILURES = rwa_schema.GENOTYPE.indices('replicate', 'dates', 'population', 'failures')
     
     # Load the data and filter it to the subset indicated by the offset
-    replicates = pd.read_csv(filename, header = None)
+    replicates = rwanda.read_dataset(filename, [REPLICATE, DATES, POPULATION, FAILURES])
     dates = replicates[DATES].unique().tolist()
 
     # Filter to the date range
@@ -167,9 +153,7 @@ def metrics():
 def plot(plot_type, path, ylabel):
   def plot_data(data, ax):
     # Find the bounds of the data
-    upper = np.percentile(data, 75, axis=0)
-    median = np.percentile(data, 50, axis=0)
-    lower = np.percentile(data, 25, axis=0)
+    lower, median, upper = rwanda.bands(data)
   
     # Add the data to the subplot
     ax.plot(dates, median)
@@ -184,10 +168,13 @@ def plot(plot_type, path, ylabel):
   figure, axes = plt.subplots(2, 3)
   ymin, ymax = sys.maxsize, 0
   
+  # Load the data for each of the cycling periods, in parallel if requested
+  periods = [90, 180, 270, 365, 545, 730]
+  parsed = rwanda.process(load, [('../Analysis/data/{}/rwa-cycling-{}.csv'.format(path, days), plot_type) for days in periods])
+
   row, col = 0, 0
-  for days in [90, 180, 270, 365, 545, 730]:
-    # Load the data, format the dates, and plot
-    dates, frequency = load('../Analysis/data/{}/rwa-cycling-{}.csv'.format(path, days), plot_type)
+  for days, (dates, frequency) in zip(periods, parsed):
+    # Format the dates, and plot
     startDate = datetime.datetime.strptime(rwanda.STUDYDATE, "%Y-%m-%d")
     dates = [startDate + datetime.timedelta(days=x) for x in dates]  
     ranges = plot_data(frequency, axes[row, col])
@@ -224,7 +211,9 @@ if __name__ == '__main__':
   parser.add_argument('-c', action='store_true', dest='comparison', help='Compare 90, 180 day introduction orders')
   parser.add_argument('-m', action='store_true', dest='metrics', help='The number of years (from end of dataset) to calculate metrics for')
   parser.add_argument('-t', action='store', dest='type', default='line', help='Plot type, either line (default) or box')
+  parser.add_argument('-w', action='store', dest='workers', default=rwanda.WORKERS, help='The number of datasets to parse concurrently, default {}'.format(rwanda.WORKERS))
   args = parser.parse_args()
+  rwanda.WORKERS = int(args.workers)
 
   if args.metrics:    
     metrics()
@@ -3,21 +3,21 @@
 # rwa_district_plot.py
 #
 # Generate a "dashboard" style plot with the key metrics for each district in Rwanda.
+import argparse
 import datetime
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import os
-import pandas as pd
 import re
 import sys
 
 import rwanda
+import rwa_render
 
 # From the PSU-CIDD-MaSim-Support repository
 sys.path.insert(1, '../../PSU-CIDD-MaSim-Support/Python/include')
 from plotting import scale_luminosity
-from utility import progressBar
 
 def main(extension):
     root = '../Analysis/ms_data/'
@@ -34,6 +34,7 @@ def main(extension):
 
     os.makedirs('plots', exist_ok=True)
 
+    queue = rwa_render.Queue()
     for filename in filenames:
         # Prepare the filenames
         prefix = 'Movement'; suffix = 'movement rate'
@@ -54,67 +55,46 @@ def main(extension):
         if not os.path.exists(filename): continue
         print('Preparing {} plots...'.format(rate))
 
-        # Start by preparing the national summary plot
-        rwanda.plot_validation(filename, 'plots/{} Sensitivity - {}.{}'.format(prefix, rate, extension), title=title)
+        # Build the cube and its bands before the plots are rendered, the 
+        # workers then attach to the memory-mapped cube
+        cube = rwanda.open_cube(filename)
+        cube.bands(); cube.bands(rwanda.CI95)
 
-        # Now prepare the district spiking plot
-        plot_spikes(filename, rate, prefix, suffix, extension)
+        # Queue the national summary plot, the district spiking plot, and the 
+        # standard four-panel summary plot for each of the spiking districts
+        imagefile = 'plots/{} Sensitivity - {}.{}'.format(prefix, rate, extension)
+        queue.add(imagefile, rwanda.plot_validation, filename, imagefile, title)
+        queue.add('plots/District {} {}.{}'.format(prefix, rate, extension), plot_spikes, filename, rate, prefix, suffix, extension)
+        for id in spike_districts()[1]:
+            queue.add('{} {}, {}'.format(prefix, rate, rwanda.DISTRICTS[id]), render_summary, filename, id, '{} {} - '.format(prefix, rate), extension)
 
+    # Render the plots, in parallel if requested
+    failures = queue.run()
+    if len(failures) > 0:
+        sys.exit(1)
 
-def prepare(filename):
-    REPLICATE, DATES, DISTRICT, INDIVIDUALS, WEIGHTED = 1, 2, 3, 4, 8
-
-    # Load the data, note the unique dates, replicates
-    data = pd.read_csv(filename, header = None)
-    dates = data[DATES].unique().tolist()
-    replicates = data[REPLICATE].unique().tolist()
 
-    # Build the dictionary that will be used to store data
+def prepare(filename):
+    # Open the cube for the dataset and note the bands for each district
+    cube = rwanda.open_cube(filename)
     districtData = {}
     for district in rwanda.DISTRICTS:
-        districtData[district] = {}
-        for key in rwanda.REPORT_LAYOUT:
-            districtData[district][key] = []
-
-    # Start by filtering by the replicate
-    count = 0
-    for replicate in replicates:
-        byReplicate = data[data[REPLICATE] == replicate]
-
-        # Load the relevant data for each district
-        for district in rwanda.DISTRICTS:
-            byDistrict = byReplicate[byReplicate[DISTRICT] == district]
-
-            # Load the simple data
-            for key in rwanda.REPORT_LAYOUT:
-                if key != 'frequency':
-                    # Append the basic information
-                    index = rwanda.REPORT_LAYOUT[key][rwanda.REPORT_INDEX]
-                    if len(districtData[district][key]) != 0:
-                        districtData[district][key] = np.vstack((districtData[district][key], byDistrict[index]))
-                    else:
-                        districtData[district][key] = byDistrict[index]
-                else:
-                    # Append the 561H frequency data
-                    frequency = byDistrict[WEIGHTED] / byDistrict[INDIVIDUALS]
-                    if len(districtData[district][key]) != 0:
-                        districtData[district][key] = np.vstack((districtData[district][key], frequency))
-                    else:
-                        districtData[district][key] = frequency
-
-        # Update the progress bar
-        count += 1
-        progressBar(count, len(replicates))
+        districtData[district] = {key: cube.band(key, district) for key in rwanda.REPORT_LAYOUT}
+    dates = cube.dates.tolist()
     
     # Return the results
     return dates, districtData
 
 
-def plot_spikes(filename, rate, prefix, suffix, extension):
-    LOCATIONS = {
-        8: [0, 0], 3: [0, 1], 17: [0, 2],
-        4: [1, 0], 5: [1, 1], 
-    }
+# Render the four-panel summary plot for the district from the bands of the cube
+def render_summary(filename, district, prefix, extension):
+    cube = rwanda.open_cube(filename)
+    bands = {key: cube.band(key, district) for key in rwanda.REPORT_LAYOUT}
+    rwanda.plot_summary('District 561H Validation', cube.dates.tolist(), bands, district=district, studies=True, extension=extension, prefix=prefix)
+
+
+# Return the 561H data points and the districts that they are for
+def spike_districts():
     DHS_DATA = np.array([
         # Kirby et al. 2022
         [4, 'Kirehe (0.056)', datetime.datetime(2015,9,30), 0.05556],
@@ -128,11 +108,18 @@ def plot_spikes(filename, rate, prefix, suffix, extension):
         if row[rwanda.SPIKE_DISTRICT] == 0: continue
         if row[rwanda.SPIKE_DISTRICT] not in districts:
             districts.append(row[rwanda.SPIKE_DISTRICT])
+    return data_points, districts
 
-    # Generate the standard four-panel summary plot
+
+def plot_spikes(filename, rate, prefix, suffix, extension):
+    LOCATIONS = {
+        8: [0, 0], 3: [0, 1], 17: [0, 2],
+        4: [1, 0], 5: [1, 1], 
+    }
+
+    # Get the clinical data and the bands for the districts
+    data_points, districts = spike_districts()
     dates, districtData = prepare(filename)
-    for id in districts:
-        rwanda.plot_summary('District 561H Validation', dates, districtData[id], district=id, studies=True)
 
     # Format the dates
     startDate = datetime.datetime.strptime(rwanda.STUDYDATE, "%Y-%m-%d")
@@ -186,4 +173,11 @@ def plot_spikes(filename, rate, prefix, suffix, extension):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', action='store', dest='workers', default=rwanda.WORKERS, help='The number of plots to render concurrently, default {}'.format(rwanda.WORKERS))
+    parser.add_argument('--sketch', action='store', dest='sketch', default=None, help='Use approximate bands from streaming sketches for datasets with more than this many replicates, default exact bands')
+    args = parser.parse_args()
+    rwanda.WORKERS = int(args.workers)
+    rwanda.SKETCH_REPLICATES = None if args.sketch is None else int(args.sketch)
+
     main('png')
\ No newline at end of file
@@ -4,10 +4,9 @@
 #
 # Plot the 561H validation replicates, within spiking studies labeled.
 #
-# NOTE As a convenience all of the data processing is cached and the loaded 
-# by default in order to "clear" the cache, the files in /np that start with
-# the violin-cache-* prefix. The remainder of the filename is based upon 
-# filtering and should produce a unique file name.
+# NOTE As a convenience all of the data processing is cached and then loaded
+# by default, see rwa_cache.py. The cache is keyed on the datasets and the
+# reference values so it does not need to be cleared when they change.
 import argparse
 import datetime
 import matplotlib
@@ -15,18 +14,16 @@ import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 import numpy as np
 import os
-import pandas as pd
 import seaborn as sb
 import sys
 
 from dateutil.relativedelta import relativedelta
 
 import rwanda
+import rwa_cache
 import rwa_reports
-
-# From the PSU-CIDD-MaSim-Support repository
-sys.path.insert(1, '../../PSU-CIDD-MaSim-Support/Python/include')
-from utility import progressBar
+import rwa_render
+import rwa_shared
 
 
 def main(plot, year, verification, type, summary=False, breaks=[3, 5, 10]):
@@ -41,61 +38,77 @@ def main(plot, year, verification, type, summary=False, breaks=[3, 5, 10]):
         filename = os.path.join(rwanda.DATA_PATH.format(year), 'rwa-pfpr-constant.csv')
         rwanda.plot_validation(filename, 'plots/{} - 561H Verification.png'.format(year))
 
-    # Generate the requested violin plot
-    for filter_year in breaks:
-        dataset = generate(year, filter_year, summary)
-
-        EXTENSION = 'png'
-        for key in rwanda.REPORT_LAYOUT:
-            label = rwanda.REPORT_LAYOUT[key][rwanda.REPORT_YLABEL]
-            filename = 'plots/{} - {}.{}'.format(type.capitalize(), label, EXTENSION)
-            if filter_year is not None:
-                filename = 'plots/{} - {:02d}y - {}.{}'.format(type.capitalize(), filter_year, label, EXTENSION)
-            plot_violin(dataset, key, label, filename, plot)
-            print("Created {}...".format(filename))
-
+    # Generate the requested violin plots, the datasets are parsed once and each break is a window of them
+    datasets = generate(year, breaks, summary)
 
-# Generate the dataset that will be used for plotting. The first time this runs
-# it involves parsing out the data from the loaded data in the relevant directory,
-# after that it will read from the cached data.
-def generate(study_year, filter_year, summary):
-    CACHE_FILE = 'np/violin-cache-{}-{}-all.npy'
+    # Render the plots for every break, in parallel if requested, with the datasets shared with the workers
+    with rwa_shared.Published({str(filter_year): datasets[filter_year] for filter_year in breaks}) as shared:
+        queue = rwa_render.Queue()
+        for filter_year in breaks:
+            EXTENSION = 'png'
+            for key in rwanda.REPORT_LAYOUT:
+                if key == 'treatments': continue
+                label = rwanda.REPORT_LAYOUT[key][rwanda.REPORT_YLABEL]
+                filename = 'plots/{} - {}.{}'.format(type.capitalize(), label, EXTENSION)
+                if filter_year is not None:
+                    filename = 'plots/{} - {:02d}y - {}.{}'.format(type.capitalize(), filter_year, label, EXTENSION)
+                queue.add(filename, render_violin, filename, shared.handle, str(filter_year), key, label, plot)
+        failures = queue.run()
+        if len(failures) > 0:
+            sys.exit(1)
+
+
+# Render the violin plot using the dataset for the break published with the handle
+def render_violin(imagefile, handle, filter_year, filter, label, plot):
+    plot_violin(rwa_shared.attach(handle)[filter_year], filter, label, imagefile, plot)
+
+
+# Generate the datasets that will be used for plotting, one for each of the
+# breaks. The first time this runs it involves parsing out the data from the
+# loaded data in the relevant directory, after that it will read from the cached
+# data. Each dataset is only parsed once with the breaks being windows of it.
+def generate(study_year, breaks, summary):
+    # Return the cached data for any breaks that have it
+    datasets, pending = {}, []
+    for filter_year in breaks:
+        cached = None if summary else rwa_cache.load(rwanda.national_cache_key(study_year, filter_year))
+        if cached is not None:
+            print('Loading cached intervention year {}, filter on year {} ...'.format(study_year, filter_year))
+            datasets[filter_year] = cached
+        else:
+            datasets[filter_year] = {}
+            pending.append(filter_year)
+    if len(pending) == 0:
+        return datasets
 
-    # If the data was cached, return it
-    cache = CACHE_FILE.format(study_year, filter_year)
     if summary:
         print('Generating national summary plots...')
-    elif os.path.exists(cache):
-        print('Loading {} ...'.format(cache))
-        data = np.load(cache, allow_pickle=True)
-        return dict(enumerate(data.flatten(), 0))[0]
     else:
-        if filter_year is not None:
-            message = 'Parsing intervention year {}, filter on year {}.'.format(study_year, filter_year)
-        else:
-            message = 'Parsing intervention year {}, with no filter.'.format(study_year)
-        print(message)
-
-    dataset = {}
-    for filename in os.listdir(rwanda.DATA_PATH.format(study_year)):
-        # Load the data, apply the relevant filter
-        print('Parsing {} ...'.format(filename))
-        filter, prefix = None, ''
-        if filter_year is not None:
-            policy_date = datetime.datetime(study_year, 1, 1)
-            filter = policy_date + relativedelta(years=filter_year)
-            prefix = "{} - ".format(filter_year)
-        results = prepare_national(os.path.join(rwanda.DATA_PATH.format(study_year), filename), study_year, filter=filter)
-
-        # Plot the summary figure, this is mostly for sanity checks, so it only gets plotted when  parsing all data
-        if summary: rwanda.plot_summary(rwanda.CONFIGURATIONS[filename], *results, prefix=prefix)   
-        dataset[filename] = results[1]
+        filters = ', '.join(['no filter' if filter_year is None else 'year {}'.format(filter_year) for filter_year in pending])
+        print('Parsing intervention year {}, filter on {}.'.format(study_year, filters))
+
+    # Load the data once, in parallel if requested
+    filenames = rwanda.list_datasets(rwanda.DATA_PATH.format(study_year))
+    parsed = rwanda.process(prepare_national, [(os.path.join(rwanda.DATA_PATH.format(study_year), filename), study_year) for filename in filenames])
+
+    # Apply the relevant filter for each break
+    policy_date = datetime.datetime(study_year, 1, 1)
+    for filename, (dates, results) in zip(filenames, parsed):
+        for filter_year in pending:
+            filter, prefix = None, ''
+            if filter_year is not None:
+                filter = policy_date + relativedelta(years=filter_year)
+                prefix = "{} - ".format(filter_year)
+            windowed = window(dates, results, study_year, filter)
+
+            # Plot the summary figure, this is mostly for sanity checks, so it only gets plotted when  parsing all data
+            if summary: rwanda.plot_summary(rwanda.CONFIGURATIONS[filename], *windowed, prefix=prefix)
+            datasets[filter_year][filename] = windowed[1]
 
     # Cache the data before returning
-    if not os.path.exists('np'):
-        os.makedirs('np')
-    np.save(cache, dataset, allow_pickle=True)
-    return dataset
+    for filter_year in pending:
+        rwa_cache.save(rwanda.national_cache_key(study_year, filter_year), datasets[filter_year])
+    return datasets
 
 
 def plot_violin(dataset, filter, label, imagefile, plot):
@@ -177,126 +190,54 @@ def plot_violin(dataset, filter, label, imagefile, plot):
         
 
 def prepare_national(filename, year, filter=None):
-    REPLICATE, DATES, DISTRICT, INDIVIDUALS, WEIGHTED = 1, 2, 3, 4, 8
+    # Open the cube for the dataset and note the national values
+    cube = rwanda.open_cube(filename)
+    dates, results = cube.dates, cube.report()
+    startDate = datetime.datetime.strptime(rwanda.STUDYDATE, "%Y-%m-%d")
+
+    # Reject the replicates that are below the reference frequency in the 
+    # reference district on the reference date
+    rejected = np.full(len(cube.replicates), False)
+    reference = np.where(dates == (rwanda.REFERENCEDATE - startDate).days)[0]
+    if len(reference) > 0:
+        frequency = cube.frequency(rwanda.REFERENCEDISTRICT)[:, reference[0]]
+        rejected = frequency < rwanda.REFERENCEFREQUENCY
+        for value in frequency[rejected]: print(value)
+    if np.sum(rejected) > 0: print('{} replicate(s) rejected'.format(np.sum(rejected)))
+
+    for key in results:
+        results[key] = results[key][~rejected]
 
-    # Load the data, note the unique dates, replicates
+    # Return the results and dates, with the filter applied if one was given
+    return window(dates, results, year, filter)
+
+
+# Select the window of the dates from the policy date through to the filter date
+# from the results returned by prepare_national
+def window(dates, results, year, filter):
+    if filter is None:
+        return np.asarray(dates).tolist(), results
     policy_date = datetime.datetime(year, 1, 1)
-    data = pd.read_csv(filename, header = None)
-    dates = data[DATES].unique().tolist()
-    replicates = data[REPLICATE].unique().tolist()
     startDate = datetime.datetime.strptime(rwanda.STUDYDATE, "%Y-%m-%d")
-
-    # Build the dictionary for the results
-    results = {}
-    for key in rwanda.REPORT_LAYOUT:
-        results[key] = []
-
-    # Start by filtering by the replicate
-    count, failed = 0, 0
-    for replicate in replicates:
-        byReplicate = data[data[REPLICATE] == replicate]
-
-        # Prepare the data structure for this replicate
-        values = {}
-        for key in rwanda.REPORT_LAYOUT:
-            values[key] = []
-
-        # Next, filter by date so we can properly aggregate
-        rejected = False
-        for date in dates:    
-            # Stop if this replicate was rejected
-            if rejected: break
-
-            # Verify the frequency if this is the correct date
-            currentDate = startDate + datetime.timedelta(days=date)
-            byDate = byReplicate[byReplicate[DATES] == date]
-            if currentDate == rwanda.REFERENCEDATE:
-                temp = byDate[byDate[DISTRICT] == rwanda.REFERENCEDISTRICT]
-                if (temp[WEIGHTED] / temp[INDIVIDUALS]).values[0] < rwanda.REFERENCEFREQUENCY:
-                    print((temp[WEIGHTED] / temp[INDIVIDUALS]).values[0])
-                    failed += 1
-                    rejected = True
-                    continue            
-
-            # If we are filtering then check the date
-            if filter is not None:
-                if currentDate < policy_date: continue
-                if currentDate > filter: break
-
-            # Store the appropriate data
-            for key in rwanda.REPORT_LAYOUT:
-                if key != 'frequency':
-                    index = rwanda.REPORT_LAYOUT[key][rwanda.REPORT_INDEX]
-                    values[key].append(sum(byDate[index]))
-                else:
-                    values[key].append(sum(byDate[WEIGHTED]) / sum(byDate[INDIVIDUALS]))
-
-        # Update the progress bar
-        count += 1
-        progressBar(count, len(replicates))
-
-        # Add the data if not rejected
-        if rejected: continue        
-        for key in rwanda.REPORT_LAYOUT:
-            if len(results[key]) != 0:
-                results[key] = np.vstack((results[key], values[key]))
-            else:
-                results[key] = values[key]
-
-    # Return the results
-    if failed > 0: print('{} replicate(s) rejected'.format(failed))
-
-    # Select the subset of dates if a filter was applied
-    if filter is not None:
-        start, end = 0, 0
-        for ndx in range(len(dates)):
-            currentDate = startDate + datetime.timedelta(days=dates[ndx])
-            if currentDate == policy_date: 
-                start = ndx
-            if currentDate == filter:
-                end = ndx
-                break
-        dates = dates[start:end + 1]
-
-    # Return the results and dates
-    return dates, results
+    currentDates = np.array([startDate + datetime.timedelta(days=int(date)) for date in dates])
+    keep = (currentDates >= policy_date) & (currentDates <= filter)
+    return np.asarray(dates)[keep].tolist(), {key: results[key][:, keep] for key in results}
 
 
 def prepare_validation(filename):
-    REPLICATE, DATES, INDIVIDUALS, WEIGHTED = 1, 2, 4, 8
-
-    # Load the data, note the unique dates, replicates
-    data = pd.read_csv(filename, header = None)
-    dates = data[DATES].unique().tolist()
-    replicates = data[REPLICATE].unique().tolist()
-
-    # Calculate the 561H frequency for each date, replicate
-    count, frequencies = 0, []
-    for replicate in replicates:
-        byReplicate = data[data[REPLICATE] == replicate]
-        frequency = []
-        for date in dates:
-            byDate = byReplicate[byReplicate[DATES] == date]
-            frequency.append(sum(byDate[WEIGHTED]) / sum(byDate[INDIVIDUALS]))
-        if len(frequencies) != 0: frequencies = np.vstack((frequencies, frequency))
-        else: frequencies = frequency
-
-        # Update the progress bar
-        count += 1
-        progressBar(count, len(replicates))
-
-    # Return the results
-    return dates, frequencies
+    return rwanda.prepare_validation(filename)
 
 if __name__ == '__main__':
     # Parse the arguments
     plots_list = ', '.join(rwa_reports.PLOTS.keys())
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', action='store_true', dest='verification', help='Plot the verification data')
+    parser.add_argument('-w', action='store', dest='workers', default=rwanda.WORKERS, help='The number of datasets to parse concurrently, default {}'.format(rwanda.WORKERS))
     parser.add_argument('-y', action='store', dest='year', required=True, help='Year filter for the studies')
     parser.add_argument('-p', action='store', dest='plot', default='standard', 
                         help='The plot to generate, must one of: {}. Default: standard'.format(plots_list))
     args = parser.parse_args()
+    rwanda.WORKERS = int(args.workers)
 
     # Check the inputs
     plot = args.plot.lower()
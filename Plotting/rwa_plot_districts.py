@@ -7,6 +7,7 @@
 # There's a lot of cut-and-paste code taking place here around setting the 
 # plots up - longer term it should be refactored to something a bit more
 # streamlined.
+import argparse
 import datetime
 import matplotlib
 import matplotlib.pyplot as plt
@@ -15,11 +16,9 @@ import numpy as np
 import os
 import pandas as pd
 import seaborn as sb
-import sys
 
-# From the PSU-CIDD-MaSim-Support repository
-sys.path.insert(1, '../../PSU-CIDD-MaSim-Support/Python/include')
-from utility import progressBar
+import rwanda
+import rwa_schema
 
 CACHE_DIRECTORY = 'cache'
 DATASETS_PATH = '../Analysis/data/datasets'
@@ -150,16 +149,53 @@ ROTATION_LABELS = {
 }
 
 
+# Rollups of a district dataset for each replicate, the monthly values are
+# replicate x month arrays which are then summed over each of the ENDPOINTS so
+# the values for the plots can be looked up directly
+class Rollup:
+  FIELDS = ['treatments', 'failures', 'infections', 'weighted']
+
+  def __init__(self, data):
+    replicates, replicate = np.unique(data.replicate.to_numpy(), return_inverse=True)
+    self.days, day = np.unique(data.days.to_numpy(), return_inverse=True)
+    self.monthly = {}
+    for field in Rollup.FIELDS:
+      self.monthly[field] = np.zeros((len(replicates), len(self.days)))
+      self.monthly[field][replicate, day] = data[field].to_numpy()
+    
+    # Sum each of the fields over the endpoint windows
+    self.endpoints = {}
+    for endpoint, bounds in ENDPOINTS.items():
+      self.endpoints[endpoint] = {field: values[:, bounds[0]:bounds[1]].sum(axis=1) for field, values in self.monthly.items()}
+
+  # Return the 12-month average of the field over the endpoint window
+  def average(self, field, endpoint):
+    return self.endpoints[endpoint][field] / 12
+
+  # Return the percent treatment failures over the endpoint window
+  def percent_failures(self, endpoint):
+    return rwanda.ratio(self.endpoints[endpoint]['failures'], self.endpoints[endpoint]['treatments']) * 100.0
+
+  # Return the 561H frequency in the last month of the endpoint window
+  def frequency(self, endpoint):
+    month = len(self.days) - 1 if ENDPOINTS[endpoint][1] is None else len(self.days) + ENDPOINTS[endpoint][1] - 1
+    return rwanda.ratio(self.monthly['weighted'][:, month], self.monthly['infections'][:, month])
+
+
 def load_datasets(prefix):
-  datasets = {}
-  for file in os.listdir(DATASETS_PATH):  
-    if not any(value in file for value in ['baseline', 'mft']) and prefix not in file: continue
-    key = file.replace('rwa-', '').replace('.csv', '')
-    datasets[key] = load_dataset(os.path.join(DATASETS_PATH, file))
-  return datasets, datasets[key].days.unique()
+  files = [file for file in rwanda.list_datasets(DATASETS_PATH) if any(value in file for value in ['baseline', 'mft']) or prefix in file]
+  keys = [file.replace('rwa-', '').replace('.csv', '') for file in files]
+
+  # Load the datasets and prepare the rollups, in parallel if requested
+  datasets = dict(zip(keys, rwanda.process(load_rollup, [(os.path.join(DATASETS_PATH, file), ) for file in files])))
+  return datasets, datasets[keys[-1]].days
+
+def load_rollup(filename):
+  return Rollup(load_dataset(filename))
 
 def load_dataset(filename):
-  REPLICATES, DATES, INFECTIONS, WEIGHTED, TREATMENTS, FAILURES = 1, 2, 4, 8, 9, 10
+  REPLICATES, DATES, INFECTIONS, WEIGHTED, TREATMENTS, FAILURES = rwa_schema.DISTRICT.indices(
+    'replicate', 'dates', 'infections', 'weighted', 'treatments', 'failures')
 
   # Track what we've loaded while the program is running to reduce the amount of output
   if not hasattr(load_dataset, "loaded"):
@@ -176,32 +212,16 @@ def load_dataset(filename):
   # Inform the user
   print('Create cache for {} ...'.format(filename))
 
-  # The cache does not exist, start by loading the full dataset
-  data = pd.read_csv(filename, header=None)
-  dates = data[DATES].unique().tolist()
-  replicates = data[REPLICATES].unique()
-
-  # Parse the data into a list of dictionaries
-  rows = []
-  for replicate in replicates:
-    for date in dates:
-      # Filter on the combination
-      subset = data[(data[REPLICATES] == replicate) & (data[DATES] == date)]
-
-      # Parse the items into a row, append it and update the status
-      row = {
-        'replicate': replicate,
-        'days': date,
-        'treatments': np.sum(subset[TREATMENTS]),
-        'failures': np.sum(subset[FAILURES]),
-        'infections': np.sum(subset[INFECTIONS]),
-        'weighted': np.sum(subset[WEIGHTED])
-      }
-      rows.append(row)
-      progressBar(len(rows), len(dates) * len(replicates))
-  
+  # The cache does not exist, start by loading the full dataset and aggregating
+  # it by replicate and date
+  columns = {'treatments': TREATMENTS, 'failures': FAILURES, 'infections': INFECTIONS, 'weighted': WEIGHTED}
+  data = rwanda.read_dataset(filename, [REPLICATES, DATES] + list(columns.values()))
+  replicates, dates, values = rwanda.aggregate(data, columns, REPLICATES, DATES)
+
   # Copy the data to the data frame, save, and return the data
-  df = pd.DataFrame(rows)
+  df = pd.DataFrame({'replicate': np.repeat(replicates, len(dates)), 'days': np.tile(dates, len(replicates))})
+  for key in columns:
+    df[key] = values[key].reshape(-1)
   df.to_csv(cache)
   return df        
 
@@ -224,26 +244,17 @@ def annual(field, prefix, report):
     title = '{} Strategy - {} Years'.format(prefix.capitalize(), endpoint)
     filename = '{}-{}-{}-year.png'.format(prefix, field, bounds[2])
     if field == 'percent-failures':
-      plot_percent_failures(data, range, title, filename, report)
+      plot_percent_failures(data, endpoint, title, filename, report)
     else:
-      plot_field(data, range, field, title, filename, report)
+      plot_field(data, endpoint, field, title, filename, report)
 
-def plot_percent_failures(data, dates, title, filename, report):
+def plot_percent_failures(data, endpoint, title, filename, report):
   # Start by generating the plot data
   records, labels, colors = [], [], []
   for key, format in report.items():
-    # Process each replicate
-    row = []
-    for replicate in data[key].replicate.unique():
-      subset = data[key][data[key].replicate == replicate]
-      treatments = np.sum(subset[(subset.days >= dates[0]) & (subset.days <= dates[-1])].treatments)
-      failures = np.sum(subset[(subset.days >= dates[0]) & (subset.days <= dates[-1])].failures)      
-      row.append((failures / treatments) * 100.0)
-    
-    # Append the processed data
     labels.append(format[0])
     colors.append(format[1])
-    records.append(row)
+    records.append(data[key].percent_failures(endpoint))
     
   # Generate the plot
   matplotlib.rc_file(VIOLIN_CONFIGURATION)
@@ -268,20 +279,13 @@ def plot_percent_failures(data, dates, title, filename, report):
   plt.savefig(os.path.join(PLOTS_DIRECTORY, filename))
   plt.close()  
 
-def plot_field(data, dates, field, title, filename, report):
+def plot_field(data, endpoint, field, title, filename, report):
   # Start by generating the plot data
   records, labels, colors = [], [], []
   for key, format in report.items():
-    # Process each replicate
-    row = []
-    for replicate in data[key].replicate.unique():
-      subset = data[key][data[key].replicate == replicate]
-      row.append(np.sum(subset[(subset.days >= dates[0]) & (subset.days <= dates[-1])][field]) / 12)
-    
-    # Append the processed data
     labels.append(format[0])
     colors.append(format[1])
-    records.append(row)
+    records.append(data[key].average(field, endpoint))
     
   # Generate the plot
   matplotlib.rc_file(VIOLIN_CONFIGURATION)
@@ -321,14 +325,13 @@ def frequencies(prefix, report):
     # Prepare the actual plot
     title = '{} Strategy - {} Years'.format(prefix.capitalize(), endpoint)
     filename = '{}-frequency-{}-year.png'.format(prefix, bounds[2])
-    plot_frequencies(data, range[-1], title, filename, report)
+    plot_frequencies(data, endpoint, title, filename, report)
 
-def plot_frequencies(data, date, title, filename, report):
+def plot_frequencies(data, endpoint, title, filename, report):
   # Start by generating the data to plot
   records, labels, colors = [], [], []
   for key, format in report.items():
-    data[key]['frequency'] = data[key].weighted / data[key].infections
-    records.append(data[key][data[key].days == date].frequency)
+    records.append(data[key].frequency(endpoint))
     labels.append(format[0])
     colors.append(format[1])
 
@@ -354,6 +357,11 @@ def plot_frequencies(data, date, title, filename, report):
 
 
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-w', action='store', dest='workers', default=rwanda.WORKERS, help='The number of datasets to parse concurrently, default {}'.format(rwanda.WORKERS))
+  args = parser.parse_args()
+  rwanda.WORKERS = int(args.workers)
+
   os.makedirs(CACHE_DIRECTORY, exist_ok=True)
   os.makedirs(PLOTS_DIRECTORY, exist_ok=True)
 
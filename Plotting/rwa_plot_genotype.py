@@ -4,7 +4,8 @@
 #
 # Generated the more complicated overlay plots for the key manuscript figures.
 #
-# NOTE Things will crash if this is set to True and the files are not present
+# NOTE The parsed data is cached, see rwa_cache.py
+import argparse
 import csv
 import datetime
 import matplotlib
@@ -15,117 +16,133 @@ import os
 import sys
 
 import rwanda
+import rwa_cache
+import rwa_render
 import rwa_reports
+import rwa_schema
 
 from matplotlib.offsetbox import AnchoredOffsetbox, TextArea, VPacker
 
 # From the PSU-CIDD-MaSim-Support repository
 sys.path.insert(1, '../../PSU-CIDD-MaSim-Support/Python/include')
 from plotting import scale_luminosity
-from utility import progressBar
 
 # Date to start plotting from
 PLOTDATE = datetime.datetime(2020, 1, 1)
 
 INDICES = {
-    'replicate' : 0,
-    'dates' : 1,
-    'infections' : 3,
-    'treatments' : 5,
-    'failures' : 6,
-    'pfpr' : 7,
-    'freq_561h' : 10,
-    'freq_plasmepsin' : 13,
-    'freq_double' : 16
+    'replicate' : rwa_schema.GENOTYPE.index('replicate'),
+    'dates' : rwa_schema.GENOTYPE.index('dates'),
+    'infections' : rwa_schema.GENOTYPE.index('infections'),
+    'treatments' : rwa_schema.GENOTYPE.index('treatments'),
+    'failures' : rwa_schema.GENOTYPE.index('failures'),
+    'pfpr' : rwa_schema.GENOTYPE.index('pfpr'),
+    'freq_561h' : rwa_schema.GENOTYPE.index('weighted_561h'),
+    'freq_plasmepsin' : rwa_schema.GENOTYPE.index('weighted_plasmepsin'),
+    'freq_double' : rwa_schema.GENOTYPE.index('weighted_double')
 }
 
-# Generate the plot using the layout provided
-def generate(layout, year, cached=False):
-    # Load and save the data if it wasn't cached
-    if not cached:          
-        dates, data = load(layout, year)
-        if not os.path.exists('np'):
-            os.makedirs('np')
-        for key in data.keys(): 
-            filename = 'np/{}_{}'.format(year, key.split('/')[-1].replace('.csv', '-parsed.csv'))
-            writeCsv(dates, data[key], filename)
-        np.save('np/{}_{}'.format(year, layout['title']), data, allow_pickle=True)
-        np.save('np/{}_rwa-dates'.format(year), dates, allow_pickle=True)
-
-    # Data was cached, load it
-    else:
-        print('Loading  {}...'.format(layout['title']))
-        data = np.load('np/{}_{}.npy'.format(year, layout['title']), allow_pickle=True)
-        dates = np.load('np/{}_rwa-dates.npy'.format(year), allow_pickle=True)    
-        data = dict(enumerate(data.flatten(), 0))[0]
-
-    # Plot the data
-    plot(dates, year, data, layout)
-
-
-# Load all of the files that have been provided
-def load(layout, year):
-    results = {}
-    for key in layout['source']:
-        dates, result = parse(key.format(year), layout['plot'])
-        results[key] = result
-    return dates, results
+# Generate the plots for each of the layouts provided, the sources are parsed
+# once regardless of how many of the layouts use them
+def generate(layouts, year):
+    dates, data = prepare(layouts, year)
+
+    # Render the plots, in parallel if requested, with only the data they need
+    queue = rwa_render.Queue()
+    for layout in layouts:
+        queue.add(layout['title'], plot, dates[layout['source'][-1]], year, {source: data[source] for source in layout['source']}, layout)
+    failures = queue.run()
+    if len(failures) > 0:
+        sys.exit(1)
+
+
+# Note the plots that are needed from each of the unique sources used by the
+# layouts, keyed by the source as it appears in the layout
+def plan(layouts):
+    plots = {}
+    for layout in layouts:
+        for source in layout['source']:
+            plots.setdefault(source, [])
+            plots[source] += [index for index in layout['plot'] if index not in plots[source]]
+    return plots
+
+
+# Prepare the dates and results for each of the unique sources used by the 
+# layouts. The parsed data is cached for each source and loaded from the cache 
+# when the source has not changed, otherwise the source is parsed and saved.
+def prepare(layouts, year):
+    dates, data, pending = {}, {}, []
+    for source, plots in plan(layouts).items():
+        cache = cache_key(source.format(year), year, plots)
+        cached = rwa_cache.load(cache)
+        if cached is None:
+            pending.append(source)
+            continue
+        print('Loading  {}...'.format(source.format(year)))
+        dates[source], data[source] = cached['dates'].tolist(), cached['data']
+
+    # Parse the sources that weren't cached, in parallel if requested
+    if len(pending) == 0:
+        return dates, data
+    if not os.path.exists('np'):
+        os.makedirs('np')
+    plots = plan(layouts)
+    parsed = rwanda.process(parse, [(source.format(year), plots[source]) for source in pending])
+    for source, (dates[source], data[source]) in zip(pending, parsed):
+        filename = 'np/{}_{}'.format(year, source.split('/')[-1].replace('.csv', '-parsed.csv'))
+        writeCsv(dates[source], data[source], filename)
+        rwa_cache.save(cache_key(source.format(year), year, plots[source]), {'dates': dates[source], 'data': data[source]})
+    return dates, data
+
+
+# Return the cache key for the source and the plots that are parsed from it
+def cache_key(source, year, plots):
+    return rwa_cache.key([source, rwanda.columnar_path(source)], 
+                         year=year, plot=sorted(plots), plot_date=PLOTDATE, study_date=rwanda.STUDYDATE)
+
+
+# The metrics in INDICES that are needed for each of the plots
+PLOT_METRICS = {
+    'tf' : ['treatments', 'failures'],
+    'pfpr' : ['pfpr'],
+    'freq_561h' : ['infections', 'freq_561h'],
+    'freq_plasmepsin' : ['infections', 'freq_plasmepsin'],
+    'freq_double' : ['infections', 'freq_double']
+}
+
+# Load the metrics given (default, all of them in INDICES) from the genotype 
+# dataset on or after the plot date. The dataset is already national so there
+# is one row for each replicate and date, which allows every metric to be placed
+# into a replicate x month array in a single step.
+def load(filename, metrics=None):
+    if metrics is None:
+        metrics = [key for key in INDICES if key not in ['replicate', 'dates']]
+    data = rwanda.read_dataset(filename, [INDICES['replicate'], INDICES['dates']] + [INDICES[key] for key in metrics], start=PLOTDATE)
+    replicates, replicate = np.unique(data[INDICES['replicate']].to_numpy(), return_inverse=True)
+    dates, date = np.unique(data[INDICES['dates']].to_numpy(), return_inverse=True)
+    values = np.zeros((len(replicates), len(dates), len(metrics)))
+    values[replicate, date] = data[[INDICES[key] for key in metrics]].to_numpy(dtype=float)
+    return dates.tolist(), {key: values[:, :, ndx] for ndx, key in enumerate(metrics)}
+
 
 # Load a single file that contains genotype data
 def parse(filename, plots):
-    # Load the data and parse out the common data
-    data = pd.read_csv(filename, header = None)
-    dates = data[INDICES['dates']].unique().tolist()
-    replicates = data[INDICES['replicate']].unique().tolist()
+    metrics = []
+    for index in plots:
+        metrics += [key for key in PLOT_METRICS[index] if key not in metrics]
+    dates, values = load(filename, metrics)
 
-    # Note the project state date
-    startDate = datetime.datetime.strptime(rwanda.STUDYDATE, "%Y-%m-%d")
-
-    # Prepare the results data structure
+    # Calculate the values for each of the plots
     results = {}
-    for index in plots: results[index] = []
-
-    # Iterate over each of the replicates
-    count = 0
-    for replicate in replicates:
-        byReplicate = data[data[INDICES['replicate']] == replicate]
-
-        # Prepare the data structure for this replicate
-        values = {}
-        for index in plots: values[index] = []
-
-        for date in dates:
-            # Continue if we haven't got to the intervention date 
-            currentDate = startDate + datetime.timedelta(days=date)
-            if currentDate < PLOTDATE: continue
-
-            # Append the data for this date
-            byDate = byReplicate[byReplicate[INDICES['dates']] == date]
-            for index in plots:
-                if 'freq_' in index:
-                    values[index].append(byDate[INDICES[index]] / byDate[INDICES['infections']])
-                elif 'tf' == index:
-                    values[index].append((byDate[INDICES['failures']] / byDate[INDICES['treatments']]))
-                else:
-                    values[index].append(byDate[INDICES[index]])
-        
-        for index in plots:
-            values[index] = np.transpose(values[index])
-            if len(results[index]) != 0:
-                results[index] = np.vstack((results[index], values[index]))
-            else:
-                results[index] = values[index]
-
-        count += 1
-        progressBar(count, len(replicates))
-
-    # Filter the list to those after the plot date
-    temp = [startDate + datetime.timedelta(days=value) for value in dates]
-    for ndx in range(len(temp)):
-        if temp[ndx] < PLOTDATE: dates[ndx] = 0
-    dates = [value for value in dates if value != 0]
-
-    # Return the filtered dates and processed results
+    for index in plots:
+        if 'freq_' in index:
+            results[index] = rwanda.ratio(values[index], values['infections'])
+        elif 'tf' == index:
+            results[index] = rwanda.ratio(values['failures'], values['treatments'])
+        else:
+            results[index] = values[index]
+
+    # Return the dates and processed results
     return dates, results
 
 
@@ -154,9 +171,7 @@ def plot(dates, year, data, layout):
 
     # Update the current plot with the median of the data and shaded IQR
     def handle_data(axis, data, label, color, style, smooth):
-        upper = np.percentile(data, 75, axis=0)
-        median = np.percentile(data, 50, axis=0)
-        lower = np.percentile(data, 25, axis=0)
+        lower, median, upper = rwanda.bands(data)
 
         if smooth: 
             upper = pd.Series(upper).rolling(12, min_periods=1).mean()
@@ -220,45 +235,48 @@ def plot(dates, year, data, layout):
         os.makedirs('plots')
     filename = '{}/{} - {}.png'.format('plots/', year, layout['title'])
     plt.savefig(filename)
+    plt.close()
     print('Saved, {}'.format(filename))
 
+# Write the median and IQR for each keyed value as a column, with the dates as
+# the first column
 def writeCsv(dates, data, filename):
-    # Start by writing out raw CSV
+    header, columns = ['date'], [dates]
+    for key in data.keys():
+        for value, band in zip(rwanda.IQR, rwanda.bands(data[key])):
+            if key == 'pfpr':
+                band = pd.Series(band).rolling(12, min_periods=1).mean()
+            header.append('{}-{}'.format(key, value))
+            columns.append([str(item) for item in band])
     with open(filename, 'w') as out:
-        # Start by writing the dates
-        values = ','.join([str(item) for item in dates])
-        out.write("{},{}\n".format('date', values))    
-    
-        # Write the median and IQR for each keyed value
-        for key in data.keys():
-            for value in [25, 50, 75]:
-                if key == 'pfpr':
-                    values = ','.join([str(item) for item in pd.Series(np.percentile(data[key], value, axis=0)).rolling(12, min_periods=1).mean()  ])
-                else:
-                    values = ','.join([str(item) for item in np.percentile(data[key], value, axis=0)])
-                out.write("{}-{},{}\n".format(key, value, values))
-
-    # Transpose the CSV from horizontal to vertical alignment
-    values = zip(*csv.reader(open(filename, "r")))
-    csv.writer(open(filename, "w")).writerows(values)
-        
-
-def main(year, cached):
+        writer = csv.writer(out)
+        writer.writerow(header)
+        writer.writerows(zip(*columns))
+
+
+def main(year):
     # Generate all of the plots based upon the given date
-    generate(rwa_reports.al_vs_al5, year, cached)
-    generate(rwa_reports.al5_vs_asaq, year, cached)
-    generate(rwa_reports.al5_vs_dhappq, year, cached)
-    generate(rwa_reports.al5_vs_dhappq_plas, year, cached)    
-    generate(rwa_reports.al5_vs_dhappq_double, year, cached)
-    generate(rwa_reports.al5_vs_mft, year, cached)
-    generate(rwa_reports.al5_vs_cycling, year, cached)
-    generate(rwa_reports.al5_vs_tact, year, cached)
-    generate(rwa_reports.al5_vs_seq_al_asaq, year, cached)
-    generate(rwa_reports.al5_vs_seq_al_dhappq_345, year, cached)
-    generate(rwa_reports.al5_vs_seq_al_dhappq_789, year, cached)
-    generate(rwa_reports.tact_vs_seq_al_asaq, year, cached)
-    generate(rwa_reports.asaq_vs_dhappq, year, cached)
+    generate([
+        rwa_reports.al_vs_al5,
+        rwa_reports.al5_vs_asaq,
+        rwa_reports.al5_vs_dhappq,
+        rwa_reports.al5_vs_dhappq_plas,
+        rwa_reports.al5_vs_dhappq_double,
+        rwa_reports.al5_vs_mft,
+        rwa_reports.al5_vs_cycling,
+        rwa_reports.al5_vs_tact,
+        rwa_reports.al5_vs_seq_al_asaq,
+        rwa_reports.al5_vs_seq_al_dhappq_345,
+        rwa_reports.al5_vs_seq_al_dhappq_789,
+        rwa_reports.tact_vs_seq_al_asaq,
+        rwa_reports.asaq_vs_dhappq
+    ], year)
 
 
 if __name__ == '__main__':
-    main(2024, False)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', action='store', dest='workers', default=rwanda.WORKERS, help='The number of datasets to parse and plots to render concurrently, default {}'.format(rwanda.WORKERS))
+    args = parser.parse_args()
+    rwanda.WORKERS = int(args.workers)
+
+    main(2024)
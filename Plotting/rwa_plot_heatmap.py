@@ -3,10 +3,15 @@
 # rwa_plot_heatmap.py
 #
 # Plot genotype frequency heatmaps.
+import argparse
 import matplotlib.pyplot as plt
 import os
 import pandas as pd
 import seaborn as sns
+import sys
+
+import rwanda
+import rwa_render
 
 
 STUDIES = {
@@ -63,10 +68,20 @@ def make_plot(filename, output, threshold = 1e-3):
    
 
 def main(directory):
-    for file in os.listdir(directory):
+    # Render the heatmaps, in parallel if requested
+    queue = rwa_render.Queue()
+    for file in sorted(os.listdir(directory)):
         if not file.endswith('csv'): continue
-        make_plot(os.path.join(directory, file), file.replace('.csv', '.png'))
+        queue.add(file.replace('.csv', '.png'), make_plot, os.path.join(directory, file), file.replace('.csv', '.png'))
+    failures = queue.run()
+    if len(failures) > 0:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', action='store', dest='workers', default=rwanda.WORKERS, help='The number of heatmaps to render concurrently, default {}'.format(rwanda.WORKERS))
+    args = parser.parse_args()
+    rwanda.WORKERS = int(args.workers)
+
     main('../Analysis/data/heatmaps')
\ No newline at end of file
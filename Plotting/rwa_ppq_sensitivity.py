@@ -4,54 +4,35 @@
 #
 # Generate extended / supplemental figures concerning the piperaquine (PPQ) 
 # sensitvity to mutation rate and EC50.
+import argparse
 import datetime
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import sys
 
 import rwanda
+import rwa_schema
 
 sys.path.insert(1, '../../PSU-CIDD-MaSim-Support/Python/include')
 from plotting import scale_luminosity
-from utility import progressBar
 
 PATH = '../Analysis/data/datasets/{}'
 
 
 def load(filename):
-    REPLICATE, DATES, TREATMENTS, FAILURES = 1, 2, 9, 10
+    REPLICATE, DATES, TREATMENTS, FAILURES = rwa_schema.DISTRICT.indices('replicate', 'dates', 'treatments', 'failures')
 
-    # Load the data, note the unique dates, replicates
-    data = pd.read_csv(filename, header = None)
-    dates = data[DATES].unique().tolist()
-    replicates = data[REPLICATE].unique().tolist()
-
-    # Load the treatment failures from the data set
-    count, failures = 0, []
-    for replicate in replicates:
-        byReplicate = data[data[REPLICATE] == replicate]
-        temp = []
-        for date in dates:
-            byDate = byReplicate[byReplicate[DATES] == date]
-            temp.append((sum(byDate[FAILURES]) / sum(byDate[TREATMENTS])) * 100.0)
-        if len(failures) != 0: failures = np.vstack((failures, temp))
-        else: failures = temp
-
-        # Update the progress bar
-        count += 1
-        progressBar(count, len(replicates))
-
-    # Return the results
-    return dates, failures    
+    # Load the data and calculate the percent treatment failures for each 
+    # replicate and date
+    data = rwanda.read_dataset(filename, [REPLICATE, DATES, TREATMENTS, FAILURES])
+    replicates, dates, results = rwanda.aggregate(data, {'treatments': TREATMENTS, 'failures': FAILURES}, REPLICATE, DATES)
+    return dates.tolist(), rwanda.ratio(results['failures'], results['treatments']) * 100.0
 
 
 def plot_data(data, dates, ax):
     # Find the bounds of the data
-    upper = np.percentile(data, 75, axis=0)
-    median = np.percentile(data, 50, axis=0)
-    lower = np.percentile(data, 25, axis=0)
+    lower, median, upper = rwanda.as_bands(data)
 
     # Add the data to the subplot
     ax.plot(dates, median)
@@ -72,8 +53,9 @@ def sensitivity_mutation_figure(rows, cols, layout, title, filename):
             axes[row, col].set_visible(False)
             continue        
         
-        # Load the data and format the dates
-        dates, frequencies = rwanda.prepare_validation(PATH.format(item[2]))
+        # Load the national bands from the band store of the cube and format the dates
+        cube = rwanda.open_cube(PATH.format(item[2]))
+        dates, frequencies = cube.dates.tolist(), cube.band('frequency')
         startDate = datetime.datetime.strptime(rwanda.STUDYDATE, "%Y-%m-%d")
         dates = [startDate + datetime.timedelta(days=x) for x in dates]
         
@@ -104,6 +86,10 @@ def sensitivity_treatment_figure(rows, cols, layout, title, filename):
     matplotlib.rc_file('matplotlibrc-line')
     figure, axes = plt.subplots(rows, cols)
 
+    # Load the data for each of the visible plots, in parallel if requested
+    sources = [item[2] for item in layout if item[2] is not None]
+    parsed = dict(zip(sources, rwanda.process(load, [(PATH.format(source), ) for source in sources])))
+
     for item in layout:
         # Check to see if the plot is not visible
         row = item[0]; col = item[1]
@@ -111,8 +97,8 @@ def sensitivity_treatment_figure(rows, cols, layout, title, filename):
             axes[row, col].set_visible(False)
             continue
         
-        # Load the data and format the dates
-        dates, data = load(PATH.format(item[2]))
+        # Note the data and format the dates
+        dates, data = parsed[item[2]]
         startDate = datetime.datetime.strptime(rwanda.STUDYDATE, "%Y-%m-%d")
         dates = [startDate + datetime.timedelta(days=x) for x in dates]
         
@@ -137,6 +123,11 @@ def sensitivity_treatment_figure(rows, cols, layout, title, filename):
     
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', action='store', dest='workers', default=rwanda.WORKERS, help='The number of datasets to parse concurrently, default {}'.format(rwanda.WORKERS))
+    args = parser.parse_args()
+    rwanda.WORKERS = int(args.workers)
+
     layout = [
         [0, 0, 'rwa-dhappq-0.25.csv', '0.25x Mutation Rate'],
         [1, 0, 'rwa-dhappq-0.5.csv', '0.5x Mutation Rate'],
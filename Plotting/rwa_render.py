@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# rwa_render.py
+#
+# Render queue for batches of figures.
+#
+# Each job is a function that renders and saves a single figure along with its
+# arguments, which should be arrays or small handles (e.g., a filename or the
+# handle from rwa_shared.py) rather than figures. When more than one worker is
+# requested the jobs are rendered in a process pool using the Agg backend. A job
+# that fails is reported with its traceback and the remaining jobs still run,
+# callers should exit with an error when any failures are returned.
+#
+#   queue = rwa_render.Queue()
+#   queue.add('plots/example.png', plot_example, dates, data, 'plots/example.png')
+#   if len(queue.run()) > 0:
+#       sys.exit(1)
+import concurrent.futures
+import matplotlib
+import matplotlib.pyplot as plt
+import traceback
+
+import rwanda
+
+
+class Queue:
+    def __init__(self):
+        self.jobs = []
+
+    # Add the job to render the figure with the name, which is used to report
+    # on the progress of the job
+    def add(self, name, function, *args):
+        self.jobs.append((name, function, args))
+
+    # Render all of the jobs, in parallel if requested, and return the name and
+    # traceback of each job that failed
+    def run(self, workers=None):
+        workers = min(rwanda.WORKERS if workers is None else int(workers), len(self.jobs))
+        jobs, self.jobs = self.jobs, []
+        failures = []
+
+        def report(ndx, count, error):
+            if error is None:
+                print('Rendered {} ({} of {})'.format(jobs[ndx][0], count, len(jobs)))
+                return
+            print('Failed to render {} ({} of {})\n{}'.format(jobs[ndx][0], count, len(jobs), error))
+            failures.append((jobs[ndx][0], error))
+
+        if workers <= 1:
+            for ndx, (name, function, args) in enumerate(jobs):
+                report(ndx, ndx + 1, render(function, args))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initialize, initargs=(rwanda.SKETCH_REPLICATES, )) as executor:
+                futures = {executor.submit(render, function, args): ndx for ndx, (name, function, args) in enumerate(jobs)}
+                for count, future in enumerate(concurrent.futures.as_completed(futures)):
+                    try:
+                        error = future.result()
+                    except Exception:
+                        error = traceback.format_exc()
+                    report(futures[future], count + 1, error)
+
+        if len(failures) > 0:
+            print('{} of {} figures failed to render'.format(len(failures), len(jobs)))
+        return failures
+
+
+# Prepare a worker process to render figures without a display, using the same
+# sketch setting as the parent
+def initialize(sketch_replicates=None):
+    rwanda.initialize_worker(sketch_replicates)
+    matplotlib.use('Agg', force=True)
+
+
+# Render the figure, returning the traceback if it fails or None otherwise, any
+# figures left open by a failure are closed
+def render(function, args):
+    try:
+        function(*args)
+        return None
+    except Exception:
+        plt.close('all')
+        return traceback.format_exc()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# rwa_schema.py
+#
+# Layouts of the headerless datasets created by loader.py, along with the
+# compact types that are used for each column when they are loaded. Only the
+# integer counts are narrowed, the weighted values and PfPR are kept as float64
+# since the frequencies derived from them are compared against thresholds.
+#
+# The datasets are still read with positional columns, the layouts give the
+# positions by name so the scripts do not need to hard-code them, e.g.,
+#
+#   REPLICATE, DATES, WEIGHTED = rwa_schema.DISTRICT.indices('replicate', 'dates', 'weighted')
+import numpy as np
+import pandas as pd
+
+# Number of rows to parse at a time when the rows of a CSV file are filtered
+CHUNK_ROWS = 1000000
+
+
+class Layout:
+    def __init__(self, name, columns):
+        self.name = name
+        self.columns = columns
+        self.names = [column for column, dtype in columns]
+        self.dtypes = {ndx: dtype for ndx, (column, dtype) in enumerate(columns)}
+
+    # Return the position of the column
+    def index(self, name):
+        return self.names.index(name)
+
+    # Return the positions of the columns, in the order given
+    def indices(self, *names):
+        return tuple([self.index(name) for name in names])
+
+    # Return the values of the column cast to the type of the layout. Values 
+    # that are missing, or that would not survive the cast (e.g., fractions or 
+    # out of range values for an integer column), are left as they are.
+    def cast(self, column, values):
+        if column not in self.dtypes or not np.issubdtype(values.dtype, np.number) or pd.isna(values).any():
+            return values
+        dtype = np.dtype(self.dtypes[column])
+        if np.issubdtype(dtype, np.integer) and not np.issubdtype(values.dtype, np.integer):
+            if not np.array_equal(values, np.trunc(values)):
+                return values
+        if np.issubdtype(dtype, np.integer) and len(values) > 0:
+            bounds = np.iinfo(dtype)
+            if values.min() < bounds.min or values.max() > bounds.max:
+                return values
+        return values.astype(dtype, copy=False)
+
+    # Return the mask for the rows of the data that have dates in the range 
+    # [start, end] as days elapsed, either bound may be None
+    def between(self, data, start, end):
+        dates = data[self.index('dates')]
+        keep = np.full(len(dates), True)
+        if start is not None: keep &= (dates >= start)
+        if end is not None: keep &= (dates <= end)
+        return keep
+
+    # Cast the columns of the data frame to the types of the layout
+    def apply(self, data):
+        for column in self.dtypes:
+            if column in data.columns:
+                data[column] = self.cast(column, data[column].to_numpy())
+        return data
+
+
+# District dataset, one row per replicate, date, and district (see REPLICATE_SQL
+# in loader.py). The treatments and failures come from the therapy records for
+# the studies that use them.
+DISTRICT = Layout('district', [
+    ('configuration',           np.int32),
+    ('replicate',               np.int32),
+    ('dates',                   np.int32),
+    ('district',                np.int16),
+    ('infections',              np.int32),
+    ('clinical',                np.int32),
+    ('occurrences',             np.int32),
+    ('clinical_occurrences',    np.int32),
+    ('weighted',                np.float64),
+    ('treatments',              np.int32),
+    ('failures',                np.int32),
+    ('carriers',                np.int32)
+])
+
+# Genotype dataset, one row per replicate and date with the national values
+# (see GENOTYPE_SQL in loader.py)
+GENOTYPE = Layout('genotype', [
+    ('replicate',               np.int32),
+    ('dates',                   np.int32),
+    ('population',              np.int32),
+    ('infections',              np.int32),
+    ('clinical',                np.int32),
+    ('treatments',              np.int32),
+    ('failures',                np.int32),
+    ('pfpr',                    np.float64),
+    ('occurrences_561h',        np.int32),
+    ('clinical_561h',           np.int32),
+    ('weighted_561h',           np.float64),
+    ('occurrences_plasmepsin',  np.int32),
+    ('clinical_plasmepsin',     np.int32),
+    ('weighted_plasmepsin',     np.float64),
+    ('occurrences_double',      np.int32),
+    ('clinical_double',         np.int32),
+    ('weighted_double',         np.float64)
+])
+
+LAYOUTS = [DISTRICT, GENOTYPE]
+
+
+# Return the layout with the number of columns given, or None if it is unknown
+def detect(count):
+    for layout in LAYOUTS:
+        if len(layout.columns) == count:
+            return layout
+    return None
+
+
+# Read the headerless CSV file using the layout, which is detected from the
+# first row. The file is parsed with the native types and then each column is
+# cast to the compact type where the values survive the cast (see Layout.cast),
+# since pandas wraps out of range values when the compact types are parsed.
+#
+# Only the columns given are parsed, and when a start and / or end (as days
+# elapsed) are given the file is parsed in chunks with only the rows that have 
+# dates in the range being kept.
+def read_csv(filename, columns=None, start=None, end=None):
+    layout = detect(len(pd.read_csv(filename, header=None, nrows=1).columns))
+    ranged = start is not None or end is not None
+    if layout is None:
+        if ranged: raise ValueError('Unable to filter the dates of {}, the layout is unknown'.format(filename))
+        return pd.read_csv(filename, header=None, usecols=columns)
+
+    # Note the columns to parse, the dates are always needed to filter
+    usecols = None
+    if columns is not None:
+        usecols = sorted(set(columns) | (set([layout.index('dates')]) if ranged else set()))
+
+    if not ranged:
+        data = layout.apply(pd.read_csv(filename, header=None, usecols=usecols))
+    else:
+        chunks = []
+        for chunk in pd.read_csv(filename, header=None, usecols=usecols, chunksize=CHUNK_ROWS):
+            chunks.append(layout.apply(chunk[layout.between(chunk, start, end)].copy()))
+        data = pd.concat(chunks, ignore_index=True)
+    return data if columns is None else data[list(columns)]
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# rwa_shared.py
+#
+# Share datasets that are already loaded with worker processes without copying.
+#
+# The publisher writes the arrays once as .npy files in a temporary directory,
+# on /dev/shm when it is present so nothing touches the disk, and passes the
+# directory to the workers as the handle. Workers attach to the arrays as
+# read-only memory maps, so every worker shares the same pages and the memory
+# used does not grow with the number of workers. When there is only a single
+# worker nothing is published and the handle is the values themselves.
+#
+#   with rwa_shared.Published(dataset) as shared:
+#       rwanda.process(render, [(filename, shared.handle) for filename in filenames])
+#
+#   def render(filename, handle):
+#       dataset = rwa_shared.attach(handle)
+import numpy as np
+import os
+import shutil
+import tempfile
+
+import rwa_cache
+import rwanda
+
+# The directory to publish to when it is present, otherwise the system default
+SHARED_DIRECTORY = '/dev/shm'
+
+
+class Published:
+    # Publish the values, which may be nested dictionaries of arrays, for the 
+    # number of workers given (default, rwanda.WORKERS). If the values can't be
+    # written to the SHARED_DIRECTORY (e.g., it is too small) the system default
+    # temporary directory is used instead.
+    def __init__(self, values, workers=None):
+        self.handle = values
+        if (rwanda.WORKERS if workers is None else int(workers)) <= 1:
+            return
+        flattened = rwa_cache.flatten(values)
+        try:
+            self.handle = self.write(flattened, SHARED_DIRECTORY if os.path.isdir(SHARED_DIRECTORY) else None)
+        except OSError:
+            self.handle = self.write(flattened, None)
+
+    # Write the flattened values to a new temporary directory in the directory
+    def write(self, flattened, directory):
+        path = tempfile.mkdtemp(prefix='rwa-', dir=directory)
+        try:
+            np.save(os.path.join(path, 'names.npy'), np.array(list(flattened.keys()), dtype=str), allow_pickle=False)
+            for ndx, value in enumerate(flattened.values()):
+                np.save(os.path.join(path, '{}.npy'.format(ndx)), value, allow_pickle=False)
+        except OSError:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        return path
+
+    # Remove the published values, any workers must be done with them
+    def close(self):
+        if isinstance(self.handle, str):
+            shutil.rmtree(self.handle, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+# Attach to the values published with the handle, the arrays are read-only
+def attach(handle):
+    if not isinstance(handle, str):
+        return handle
+    names = np.load(os.path.join(handle, 'names.npy'), allow_pickle=False).tolist()
+    return rwa_cache.unflatten({name: np.load(os.path.join(handle, '{}.npy'.format(ndx)), mmap_mode='r') for ndx, name in enumerate(names)})
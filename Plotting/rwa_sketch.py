@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# rwa_sketch.py
+#
+# Mergeable streaming quantile sketches for the monthly bands.
+#
+# Each sketch tracks a fixed number of columns (e.g., months) and replicates are
+# folded in one row at a time. The sketch follows KLL (Karnin, Lang, and Liberty
+# 2016), values are held in a stack of compactors where an item at level h has
+# a weight of 2^h. When a compactor is over capacity it is sorted and every
+# other item, starting at a random offset, is promoted to the next level. This
+# bounds the memory to roughly 3k items per column regardless of the number of
+# replicates and sketches built from different shards can be merged.
+#
+# Until the first compaction the sketch is exact, so the bands for studies with
+# fewer than k replicates are the same as those from np.percentile.
+import numpy as np
+import os
+
+# Default size of the largest compactor, the rank error is roughly 1.7 / k
+K = 200
+
+# Ratio used for the capacities of the lower compactors
+RATIO = 2 / 3
+
+
+class Sketch:
+    def __init__(self, columns, k=K, seed=None):
+        self.columns = columns
+        self.k = k
+        self.count = 0
+        self.levels = [np.empty((0, columns))]
+        self.missing = np.full(columns, False)
+        self.random = np.random.default_rng(seed)
+
+    # Return the capacity of the compactor at the level
+    def capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * RATIO ** depth)))
+
+    # Fold a single row (i.e., replicate) of values in to the sketch
+    def update(self, values):
+        values = np.asarray(values, dtype=float).reshape(1, self.columns)
+        self.missing |= np.isnan(values[0])
+        self.levels[0] = np.vstack([self.levels[0], values])
+        self.count += 1
+        self.compress()
+
+    # Merge the other sketch in to this one
+    def merge(self, other):
+        if other.columns != self.columns:
+            raise ValueError('Unable to merge sketches with {} and {} columns'.format(self.columns, other.columns))
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty((0, self.columns)))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.vstack([self.levels[level], items])
+        self.count += other.count
+        self.missing |= other.missing
+        self.compress()
+
+    # Compact any levels that are over capacity
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) >= self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty((0, self.columns)))
+                items = np.sort(self.levels[level], axis=0)
+
+                # An odd item out stays at the current level
+                keep = items[:0]
+                if len(items) % 2 == 1:
+                    keep, items = items[-1:], items[:-1]
+                self.levels[level + 1] = np.vstack([self.levels[level + 1], items[self.random.integers(2)::2]])
+                self.levels[level] = keep
+            level += 1
+
+    # Return the lower, median, and upper bands for the quantiles given (e.g.,
+    # [25, 50, 75]), columns with missing values are NaN as with np.percentile
+    def bands(self, quantiles):
+        if len(self.levels) == 1:
+            results = np.percentile(self.levels[0], quantiles, axis=0)
+        else:
+            # Sort the items in each column along with their weights
+            values = np.vstack(self.levels)
+            weights = np.concatenate([np.full(len(items), 2.0 ** level) for level, items in enumerate(self.levels)])
+            order = np.argsort(values, axis=0)
+            values = np.take_along_axis(values, order, axis=0)
+            weights = weights[order]
+
+            # Interpolate the quantiles from the midpoints of the weighted ranks
+            cumulative = np.cumsum(weights, axis=0)
+            position = (cumulative - weights / 2) / cumulative[-1]
+            results = np.empty((len(quantiles), self.columns))
+            for column in range(self.columns):
+                results[:, column] = np.interp(np.asarray(quantiles) / 100.0, position[:, column], values[:, column])
+        results[:, self.missing] = np.nan
+        lower, median, upper = results
+        return lower, median, upper
+
+    # Save the sketch so that it can be updated later
+    def save(self, filename):
+        values = {'level_{}'.format(level): items for level, items in enumerate(self.levels)}
+        values.update({'count': self.count, 'k': self.k, 'missing': self.missing})
+        temp = filename + '.tmp'
+        with open(temp, 'wb') as out:
+            np.savez(out, **values)
+        os.replace(temp, filename)
+
+
+# Load the sketch that was saved to the filename
+def load(filename, seed=None):
+    with np.load(filename, allow_pickle=False) as data:
+        levels = sorted([name for name in data.files if name.startswith('level_')], key=lambda name: int(name[6:]))
+        sketch = Sketch(len(data['missing']), int(data['k']), seed)
+        sketch.levels = [data[name] for name in levels]
+        sketch.count = int(data['count'])
+        sketch.missing = data['missing']
+    return sketch
@@ -3,19 +3,26 @@
 # This file contains common properties for Rwanda and associated reporting.
 
 # Districts in Rwanda, keyed for the GIS data
+import collections
+import concurrent.futures
 import datetime
+import hashlib
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import os
 import pandas as pd
 import re
+import shutil
 import sys
 
 # From the PSU-CIDD-MaSim-Support repository
 sys.path.insert(1, '../../PSU-CIDD-MaSim-Support/Python/include')
 from plotting import scale_luminosity
-from utility import progressBar
+
+import rwa_cache
+import rwa_schema
+import rwa_sketch
 
 
 DISTRICTS = {
@@ -67,6 +74,45 @@ REFERENCEFREQUENCY = 0.01
 # The path for the summary data set
 DATA_PATH = '../Analysis/ms_data/{}/datasets'
 
+# Datasets can be stored as headerless CSV files and / or in a columnar format,
+# which is a directory with one typed .npy file per column. When both are 
+# present the columnar copy is preferred since it does not need to be parsed.
+COLUMNAR_EXTENSION = '.cols'
+DATASET_FORMATS = ['csv', 'columnar', 'both']
+
+# The aggregated district datasets can be stored as a cube, which is a directory
+# with a memory-mapped replicate x month x district x metric array along with 
+# the values for each axis. District zero of the cube is the national total.
+CUBE_EXTENSION = '.cube'
+
+# The columns of the district datasets that are stored as metrics in the cube
+DISTRICT_METRICS = {name: rwa_schema.DISTRICT.index(name) for name in [
+    'infections', 'clinical', 'occurrences', 'clinical_occurrences', 'weighted', 'treatments', 'failures', 'carriers']}
+
+# The number of worker processes used by process, one is serial
+WORKERS = 1
+
+# Cubes with more replicates than this have their bands found using streaming
+# sketches (see rwa_sketch.py) instead of exact percentiles, so only a single 
+# replicate of the cube is read into memory at a time while the bands are found
+# (the cube itself is still built from the full dataset). The bands are then 
+# approximate, so this is opt-in and None always uses exact percentiles.
+SKETCH_REPLICATES = None
+
+# The sketches for a cube are saved alongside it in a directory with this 
+# extension, so they outlive the cube and only new replicates are folded in
+SKETCH_EXTENSION = '.sketch'
+
+# The memory budget in bytes for the datasets that are kept by read_dataset so 
+# that loading the same dataset again in a run is free, zero disables this. The
+# budget is for the main process only, the memo is disabled in worker processes
+# (see initialize_worker) so the memory used does not grow with the workers.
+MEMO_BUDGET = 1024 ** 3
+
+# The datasets and cubes kept in memory, least recently used first, as 
+# key: (size, value), see recall and remember
+MEMO = collections.OrderedDict()
+
 # The various configurations that are run for the simulation
 CONFIGURATIONS = {
     # Status quo
@@ -183,24 +229,42 @@ REPORT_INDEX, REPORT_ROW, REPORT_COLUMN, REPORT_YLABEL = range(4)
 
 # Four-panel report layout
 REPORT_LAYOUT = {
-    'cases': [5, 0, 0, 'Clinical Cases'],
-    'failures': [10, 1, 0, 'Treatment Failures'], 
+    'cases': [rwa_schema.DISTRICT.index('clinical'), 0, 0, 'Clinical Cases'],
+    'failures': [rwa_schema.DISTRICT.index('failures'), 1, 0, 'Treatment Failures'], 
     'frequency' : [-1, 0, 1, '561H Frequency'],
-    'carriers': [11, 1, 1, 'Individuals with 561H Clones'],
+    'carriers': [rwa_schema.DISTRICT.index('carriers'), 1, 1, 'Individuals with 561H Clones'],
 
     # Sentinel used to store data to calculate the average monthly treatment failures
-    'monthly_failures': [10, 1, 0, 'Treatment Failures, Count'], 
+    'monthly_failures': [rwa_schema.DISTRICT.index('failures'), 1, 0, 'Treatment Failures, Count'], 
 
     # Sentinel used to store data to calculate percent treatment failures
-    'treatments' : [9, -1, -1, 'Treatments']
+    'treatments' : [rwa_schema.DISTRICT.index('treatments'), -1, -1, 'Treatments']
 }
 
 
+# Quantiles for the bands, the interquartile range and the 95% interval
+IQR = [25, 50, 75]
+CI95 = [2.5, 50, 97.5]
+
+
+# Return the lower, median, and upper bands of the replicate x month data for
+# the quantiles given, all of the quantiles are found in a single pass
+def bands(data, quantiles=IQR):
+    lower, median, upper = np.percentile(data, quantiles, axis=0)
+    return lower, median, upper
+
+
+# Return the bands for the data, which is either replicate x month values or
+# bands that have already been calculated (e.g., from Cube.bands)
+def as_bands(data, quantiles=IQR):
+    if isinstance(data, tuple):
+        return data
+    return bands(data, quantiles)
+
+
 def plot_data(data, dates, ax):
     # Find the bounds of the data
-    upper = np.percentile(data, 75, axis=0)
-    median = np.percentile(data, 50, axis=0)
-    lower = np.percentile(data, 25, axis=0)
+    lower, median, upper = as_bands(data)
 
     # Add the data to the subplot
     ax.plot(dates, median)
@@ -225,10 +289,7 @@ def plot_summary(title, dates, figureData, district = None, studies = False, ext
         row, col = REPORT_LAYOUT[key][REPORT_ROW], REPORT_LAYOUT[key][REPORT_COLUMN]
 
         # Load the data and calculate the bounds      
-        data = figureData[key]  
-        upper = np.percentile(data, 75, axis=0)
-        median = np.percentile(data, 50, axis=0)
-        lower = np.percentile(data, 25, axis=0)
+        lower, median, upper = as_bands(figureData[key])
 
         # Add the data to the subplot
         axes[row, col].plot(dates, median)
@@ -271,17 +332,13 @@ def plot_summary(title, dates, figureData, district = None, studies = False, ext
 
 
 def plot_validation(datafile, imagefile, title='Rwanda 561H Frequency Validation'):
-    # Prepare the data
-    dates, frequencies = prepare_validation(datafile)
+    # Prepare the data, the national bounds are from the band store of the cube
+    cube = open_cube(datafile)
+    lower, median, upper = cube.band('frequency', quantiles=CI95)
 
     # Format the dates
     startDate = datetime.datetime.strptime(STUDYDATE, "%Y-%m-%d")
-    dates = [startDate + datetime.timedelta(days=x) for x in dates]
-
-    # Calculate the bounds
-    upper = np.percentile(frequencies, 97.5, axis=0)
-    median = np.percentile(frequencies, 50, axis=0)
-    lower = np.percentile(frequencies, 2.5, axis=0)
+    dates = [startDate + datetime.timedelta(days=x) for x in cube.dates.tolist()]
 
     # Format the plot
     matplotlib.rc_file('matplotlibrc-line')
@@ -312,27 +369,456 @@ def plot_validation(datafile, imagefile, title='Rwanda 561H Frequency Validation
 
 
 def prepare_validation(filename):
-    REPLICATE, DATES, INDIVIDUALS, WEIGHTED = 1, 2, 4, 8
-
-    # Load the data, note the unique dates, replicates
-    data = pd.read_csv(filename, header = None)
-    dates = data[DATES].unique().tolist()
-    replicates = data[REPLICATE].unique().tolist()
-
-    # Calculate the 561H frequency for each date, replicate
-    count, frequencies = 0, []
-    for replicate in replicates:
-        byReplicate = data[data[REPLICATE] == replicate]
-        frequency = []
-        for date in dates:
-            byDate = byReplicate[byReplicate[DATES] == date]
-            frequency.append(sum(byDate[WEIGHTED]) / sum(byDate[INDIVIDUALS]))
-        if len(frequencies) != 0: frequencies = np.vstack((frequencies, frequency))
-        else: frequencies = frequency
-
-        # Update the progress bar
-        count += 1
-        progressBar(count, len(replicates))
-
-    # Return the results
-    return dates, frequencies
\ No newline at end of file
+    # Calculate the national 561H frequency for each replicate, date
+    cube = open_cube(filename)
+    return cube.dates.tolist(), cube.frequency()
+
+
+# Aggregate the columns of the dataset by replicate and date, and optionally by
+# district, in a single pass. The replicates and dates are returned in the order
+# that they appear in the dataset along with a dense array for each column that
+# is shaped (replicate, date) or (replicate, date, district), with the districts
+# ordered by their id. Combinations not present in the dataset are zero.
+def aggregate(data, columns, replicate=1, dates=2, district=None):
+    replicateCodes, replicates = pd.factorize(data[replicate])
+    dateCodes, days = pd.factorize(data[dates])
+    shape = [len(replicates), len(days)]
+    keys = replicateCodes * len(days) + dateCodes
+    if district is not None:
+        districts = np.array(sorted(DISTRICTS.keys()))
+        keys = keys * len(districts) + np.searchsorted(districts, data[district].to_numpy())
+        shape.append(len(districts))
+
+    # Sum each of the columns into the dense array, integer columns stay integers
+    results, size = {}, int(np.prod(shape))
+    for key, column in columns.items():
+        values = data[column].to_numpy()
+        result = np.bincount(keys, weights=values, minlength=size).reshape(shape)
+        if np.issubdtype(values.dtype, np.integer): result = result.astype(np.int64)
+        results[key] = result
+    return replicates.to_numpy(), days.to_numpy(), results
+
+
+# Call the function for each of the argument tuples, returning the results in
+# the same order. When more than one worker is requested the calls are fanned 
+# out to a process pool. Progress is reported as each dataset (i.e., the first
+# argument) is completed.
+def process(function, arguments, workers=None):
+    workers = WORKERS if workers is None else int(workers)
+    results = [None] * len(arguments)
+
+    def report(ndx, count):
+        print('Processed {} ({} of {})'.format(os.path.basename(str(arguments[ndx][0])), count, len(arguments)))
+
+    if workers <= 1 or len(arguments) <= 1:
+        for ndx, args in enumerate(arguments):
+            results[ndx] = function(*args)
+            report(ndx, ndx + 1)
+        return results
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(arguments)), initializer=initialize_worker, initargs=(SKETCH_REPLICATES, )) as executor:
+        futures = {executor.submit(function, *args): ndx for ndx, args in enumerate(arguments)}
+        for count, future in enumerate(concurrent.futures.as_completed(futures)):
+            results[futures[future]] = future.result()
+            report(futures[future], count + 1)
+    return results
+
+
+# Prepare a worker process for process (or rwa_render.py), the memo is disabled
+# so that each worker does not keep its own copy of the datasets, and the sketch
+# setting of the parent is used so the workers find the same bands
+def initialize_worker(sketch_replicates=None):
+    global MEMO_BUDGET, SKETCH_REPLICATES
+    MEMO_BUDGET = 0
+    MEMO.clear()
+    SKETCH_REPLICATES = sketch_replicates
+
+
+# Divide the aggregated values without warnings, where the denominator is zero
+# the result is NaN for a zero numerator and inf otherwise
+def ratio(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return numerator / denominator
+
+
+# The cube for a district dataset, the data is memory-mapped so slicing out a
+# metric for a district, or nationally, does not copy or parse anything
+class Cube:
+    def __init__(self, path):
+        self.path = path
+        self.data = np.load(os.path.join(path, 'data.npy'), mmap_mode='r')
+        self.replicates = np.load(os.path.join(path, 'replicates.npy'))
+        self.dates = np.load(os.path.join(path, 'dates.npy'))
+        self.districts = np.load(os.path.join(path, 'districts.npy'))
+        self.metrics = np.load(os.path.join(path, 'metrics.npy')).tolist()
+        self.digests = np.load(os.path.join(path, 'digests.npy'))
+        self.signature = hashlib.sha1(self.digests.tobytes()).hexdigest()[:12]
+        self.loaded = {}
+
+    # Return the replicate x month values of the metric, district zero is national
+    def metric(self, name, district=0):
+        return self.data[:, :, np.searchsorted(self.districts, district), self.metrics.index(name)]
+
+    # Return the replicate x month 561H frequency, district zero is national
+    def frequency(self, district=0):
+        return ratio(self.metric('weighted', district), self.metric('infections', district))
+
+    # Return the replicate x month values for each metric in the REPORT_LAYOUT
+    def report(self, district=0):
+        data = self.data[:, :, np.searchsorted(self.districts, district), :]
+        return {key: self.values(data, key) for key in REPORT_LAYOUT}
+
+    # Return the values of the metric in the REPORT_LAYOUT from a slice of the
+    # cube, the last axis of the slice must be the metrics
+    def values(self, data, key):
+        if key == 'frequency':
+            return ratio(data[..., self.metrics.index('weighted')], data[..., self.metrics.index('infections')])
+        index = REPORT_LAYOUT[key][REPORT_INDEX]
+        return data[..., self.metrics.index([name for name in DISTRICT_METRICS if DISTRICT_METRICS[name] == index][0])]
+
+    # Return a sketch for each metric in the REPORT_LAYOUT with a column for 
+    # each district and month. The sketches are saved alongside the cube along
+    # with the replicates folded into them and their digests, so when the cube 
+    # is rebuilt only the new replicates are folded in (one at a time) and 
+    # merged. The sketches are started over if the dates changed or any of the
+    # replicates folded in were removed or changed.
+    def sketches(self, k=rwa_sketch.K):
+        path = os.path.splitext(self.path)[0] + SKETCH_EXTENSION
+        sketches, folded, digests = self.saved_sketches(path, k), self.replicates[:0], self.digests[:0]
+        if sketches is None:
+            sketches = {key: rwa_sketch.Sketch(len(self.districts) * len(self.dates), k) for key in REPORT_LAYOUT}
+        else:
+            folded, digests = np.load(os.path.join(path, 'replicates.npy')), np.load(os.path.join(path, 'digests.npy'))
+        pending = np.flatnonzero(~np.isin(self.replicates, folded))
+        if len(pending) == 0:
+            return sketches
+
+        # Fold the new replicates into their own sketches, then merge them
+        updates = {key: rwa_sketch.Sketch(len(self.districts) * len(self.dates), k) for key in REPORT_LAYOUT}
+        for ndx in pending:
+            data = np.asarray(self.data[ndx])
+            for key in REPORT_LAYOUT:
+                updates[key].update(self.values(data, key).T)
+        for key in REPORT_LAYOUT:
+            sketches[key].merge(updates[key])
+
+        # Save the sketches and the replicates that are now folded into them
+        temp = prepare_temp(path)
+        for key, sketch in sketches.items():
+            sketch.save(os.path.join(temp, '{}.npz'.format(key)))
+        np.save(os.path.join(temp, 'replicates.npy'), np.concatenate([folded, self.replicates[pending]]), allow_pickle=False)
+        np.save(os.path.join(temp, 'digests.npy'), np.concatenate([digests, self.digests[pending]]), allow_pickle=False)
+        np.save(os.path.join(temp, 'dates.npy'), self.dates, allow_pickle=False)
+        replace_path(temp, path)
+        return sketches
+
+    # Return the sketches saved to the path, or None if there are none or they
+    # can't be updated for this cube
+    def saved_sketches(self, path, k):
+        filenames = [os.path.join(path, '{}.npz'.format(key)) for key in REPORT_LAYOUT]
+        if not all([os.path.exists(filename) for filename in filenames + [os.path.join(path, name) for name in ['replicates.npy', 'digests.npy', 'dates.npy']]]):
+            return None
+        if not np.array_equal(np.load(os.path.join(path, 'dates.npy')), self.dates):
+            return None
+        folded, digests = np.load(os.path.join(path, 'replicates.npy')), np.load(os.path.join(path, 'digests.npy'))
+        if not np.isin(folded, self.replicates).all():
+            return None
+        if not np.array_equal(digests, self.digests[np.searchsorted(self.replicates, folded)]):
+            return None
+        sketches = {key: rwa_sketch.load(filename) for key, filename in zip(REPORT_LAYOUT, filenames)}
+        if any([sketch.k != k or sketch.columns != len(self.districts) * len(self.dates) for sketch in sketches.values()]):
+            return None
+        return sketches
+
+    # Return the quantile x district x month bands for each metric in the 
+    # REPORT_LAYOUT. The bands are stored with the cube under its signature, so
+    # they are calculated once for each set of quantiles and replaced along with
+    # the cube. Approximate bands from the sketches are only used when opted in
+    # to with SKETCH_REPLICATES, and the user is told when they are.
+    def bands(self, quantiles=IQR):
+        sketched = SKETCH_REPLICATES is not None and len(self.replicates) > SKETCH_REPLICATES
+        name = 'bands-{}-{}{}.npz'.format('-'.join([str(value) for value in quantiles]), self.signature, '-sketch' if sketched else '')
+        path = os.path.join(self.path, name)
+        if path in self.loaded:
+            return self.loaded[path]
+        if sketched:
+            print('Using approximate bands from sketches for {} ({} replicates)'.format(os.path.basename(self.path), len(self.replicates)))
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as data:
+                self.loaded[path] = {key: data[key] for key in data.files}
+            return self.loaded[path]
+
+        shape = (len(quantiles), len(self.districts), len(self.dates))
+        if sketched:
+            results = {key: np.array(sketch.bands(quantiles)).reshape(shape) for key, sketch in self.sketches().items()}
+        else:
+            results = {key: np.empty(shape) for key in REPORT_LAYOUT}
+            for ndx, district in enumerate(self.districts):
+                for key, values in self.report(district).items():
+                    results[key][:, ndx, :] = np.percentile(values, quantiles, axis=0)
+        temp = path + '.tmp'
+        with open(temp, 'wb') as out:
+            np.savez(out, **results)
+        os.replace(temp, path)
+        self.loaded[path] = results
+        return results
+
+    # Return the lower, median, and upper bands of the metric from the stored
+    # bands, district zero is national
+    def band(self, name, district=0, quantiles=IQR):
+        lower, median, upper = self.bands(quantiles)[name][:, np.searchsorted(self.districts, district), :]
+        return lower, median, upper
+
+
+# Return the cache key (see rwa_cache.py) for the national datasets parsed by
+# rwa_national_plot.py for the study year and filter, this covers the datasets
+# and the values used to reject replicates
+def national_cache_key(study_year, filter_year):
+    path = DATA_PATH.format(study_year)
+    filenames = []
+    for filename in list_datasets(path):
+        filenames += [os.path.join(path, filename), columnar_path(os.path.join(path, filename))]
+    return rwa_cache.key(filenames, study_year=study_year, filter_year=filter_year, study_date=STUDYDATE,
+                         reference_date=REFERENCEDATE, reference_district=REFERENCEDISTRICT, 
+                         reference_frequency=REFERENCEFREQUENCY)
+
+
+# Return the path of the cube for the dataset given by the filename
+def cube_path(filename):
+    return os.path.splitext(filename)[0] + CUBE_EXTENSION
+
+
+# Open the cube for the district dataset, the cube is built from the dataset if 
+# it is not present or older than the dataset. The cube is kept in memory, so
+# opening it again in the same run returns the same cube and its bands.
+def open_cube(filename):
+    key = ('cube', os.path.abspath(filename), stamp(filename))
+    cube = recall(key)
+    if cube is not None:
+        return cube
+    if not dataset_exists(filename):
+        raise FileNotFoundError('Unable to open the cube for {}, the dataset does not exist'.format(filename))
+    path = cube_path(filename)
+    modified = max([os.path.getmtime(path) for path in [filename, columnar_path(filename)] if os.path.exists(path)])
+    if not os.path.isdir(path) or os.path.getmtime(path) < modified or not os.path.exists(os.path.join(path, 'digests.npy')):
+        write_cube(filename)
+    cube = Cube(path)
+    remember(key, cube, 0)
+    return cube
+
+
+# Build the cube for the district dataset and write it, the cube is written to
+# a temporary directory first and then moved into place. The digest of the rows
+# of each replicate is saved with the cube so the sketches and bands can tell
+# when the data for a replicate has changed.
+def write_cube(filename):
+    REPLICATE, DATES, DISTRICT = rwa_schema.DISTRICT.indices('replicate', 'dates', 'district')
+    data = read_dataset(filename, [REPLICATE, DATES, DISTRICT] + list(DISTRICT_METRICS.values()), memo=False)
+    replicates, dates, results = aggregate(data, DISTRICT_METRICS, REPLICATE, DATES, DISTRICT)
+
+    # Stack the metrics and prepend the national totals as district zero
+    cube = np.stack([results[name] for name in DISTRICT_METRICS], axis=-1).astype(np.float64)
+    cube = np.concatenate([cube.sum(axis=2, keepdims=True), cube], axis=2)
+    districts = np.array([0] + sorted(DISTRICTS.keys()))
+
+    temp = prepare_temp(cube_path(filename))
+    np.save(os.path.join(temp, 'data.npy'), cube, allow_pickle=False)
+    np.save(os.path.join(temp, 'replicates.npy'), replicates, allow_pickle=False)
+    np.save(os.path.join(temp, 'dates.npy'), dates, allow_pickle=False)
+    np.save(os.path.join(temp, 'districts.npy'), districts, allow_pickle=False)
+    np.save(os.path.join(temp, 'metrics.npy'), np.array(list(DISTRICT_METRICS.keys())), allow_pickle=False)
+    np.save(os.path.join(temp, 'digests.npy'), np.array([hashlib.sha1(values.tobytes()).hexdigest() for values in cube]), allow_pickle=False)
+    replace_path(temp, cube_path(filename))
+
+
+# Return the path of the columnar copy of the dataset given by the filename
+def columnar_path(filename):
+    return os.path.splitext(filename)[0] + COLUMNAR_EXTENSION
+
+
+# Check to see if the dataset exists in either format
+def dataset_exists(filename):
+    return os.path.exists(filename) or os.path.isdir(columnar_path(filename))
+
+
+# List the datasets in the directory by their CSV filename, regardless of the
+# format(s) that they are actually stored in
+def list_datasets(directory):
+    datasets = set()
+    for filename in os.listdir(directory):
+        if filename.endswith('.csv'):
+            datasets.add(filename)
+        elif filename.endswith(COLUMNAR_EXTENSION):
+            datasets.add(filename.replace(COLUMNAR_EXTENSION, '.csv'))
+    return sorted(datasets)
+
+
+# Read the dataset, returning a data frame with positional columns in the same
+# way as pd.read_csv(filename, header=None). The columnar copy of the dataset is
+# used when it is present and at least as new as the CSV file.
+#
+# When the columns are given only they are read, and when a start and / or end 
+# is given (as days elapsed or a datetime) only the rows with dates in the range 
+# [start, end] are read.
+#
+# The data frame is kept in memory (see MEMO_BUDGET) so reading the dataset 
+# again with the same, or a subset of the, columns and range does not parse it
+# again. The values are shared with the data frame kept, so they should not be 
+# modified in-place. One-shot reads should set memo to False so they do not 
+# push out the datasets that are read again.
+def read_dataset(filename, columns=None, start=None, end=None, memo=True):
+    start, end = days_elapsed(start), days_elapsed(end)
+    if not memo:
+        return parse_dataset(filename, columns, start, end)
+    prefix = ('dataset', os.path.abspath(filename), stamp(filename), start, end)
+    for key in reversed(MEMO):
+        if key[:-1] != prefix: continue
+        if columns is None and key[-1] is None:
+            return recall(key).copy(deep=False)
+        if columns is not None and (key[-1] is None or set(columns) <= set(key[-1])):
+            return recall(key)[list(columns)]
+
+    data = parse_dataset(filename, columns, start, end)
+    remember(prefix + (None if columns is None else tuple(columns), ), data, data.memory_usage(index=False).sum())
+    return data.copy(deep=False)
+
+
+# Parse the dataset for read_dataset, for the columnar copy the dates are read
+# first and the remaining columns are memory-mapped so only the rows in the
+# range are copied
+def parse_dataset(filename, columns, start, end):
+    columnar = columnar_path(filename)
+    if not os.path.isdir(columnar) or (os.path.exists(filename) and os.path.getmtime(columnar) < os.path.getmtime(filename)):
+        return rwa_schema.read_csv(filename, columns, start, end)
+
+    available = sorted([int(item.replace('.npy', '')) for item in os.listdir(columnar) if item.endswith('.npy')])
+    layout = rwa_schema.detect(len(available))
+    def path(column):
+        return os.path.join(columnar, '{}.npy'.format(column))
+
+    if start is None and end is None:
+        data = pd.DataFrame({column: np.load(path(column)) for column in (available if columns is None else columns)})
+    elif layout is None:
+        raise ValueError('Unable to filter the dates of {}, the layout is unknown'.format(filename))
+    else:
+        dates = layout.index('dates')
+        keep = layout.between({dates: np.load(path(dates))}, start, end)
+        data = pd.DataFrame({column: np.load(path(column), mmap_mode='r')[keep] for column in (available if columns is None else columns)})
+    return layout.apply(data) if layout is not None else data
+
+
+# Return the modification times of the CSV file and columnar copy of the 
+# dataset, which are used to note when a kept dataset is stale
+def stamp(filename):
+    return tuple([os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in [filename, columnar_path(filename)]])
+
+
+# Return the value that was kept for the key, or None if there isn't one
+def recall(key):
+    if key not in MEMO:
+        return None
+    MEMO.move_to_end(key)
+    return MEMO[key][1]
+
+
+# Keep the value for the key, the least recently used values are dropped while
+# the sizes of those kept are over the MEMO_BUDGET
+def remember(key, value, size):
+    if MEMO_BUDGET <= 0 or size > MEMO_BUDGET:
+        return
+    MEMO[key] = (size, value)
+    MEMO.move_to_end(key)
+    while sum([size for size, value in MEMO.values()]) > MEMO_BUDGET:
+        MEMO.popitem(last=False)
+
+
+# Return the value as days elapsed from the STUDYDATE, datetimes are converted
+# and anything else is returned as-is
+def days_elapsed(value):
+    if isinstance(value, datetime.datetime):
+        return (value - datetime.datetime.strptime(STUDYDATE, "%Y-%m-%d")).days
+    return value
+
+
+# Write the data frame as a dataset using the format given, either 'csv', 
+# 'columnar', or 'both'. Each file is written to a temporary path first and
+# then moved into place, so an interrupted write never leaves a partial dataset.
+def write_dataset(filename, data, format='both'):
+    if format not in DATASET_FORMATS:
+        raise ValueError('Unknown dataset format, {}'.format(format))
+    if format in ['csv', 'both']:
+        temp = filename + '.tmp'
+        data.to_csv(temp, header=False, index=False)
+        replace_path(temp, filename)
+    if format in ['columnar', 'both']:
+        temp = prepare_temp(columnar_path(filename))
+        layout = rwa_schema.detect(len(data.columns))
+        for column in range(len(data.columns)):
+            values = data.iloc[:, column].to_numpy()
+            if layout is not None: values = layout.cast(column, values)
+            np.save(os.path.join(temp, '{}.npy'.format(column)), values, allow_pickle=False)
+        replace_path(temp, columnar_path(filename))
+
+
+# Merge the datasets given into a single dataset using the format given. The 
+# CSV file is built by streaming each of the files into the output in turn and
+# the columnar copy is built a column at a time, so at most one column across
+# all of the datasets is held in memory at once.
+def merge_datasets(filenames, outfile, format='both'):
+    if format not in DATASET_FORMATS:
+        raise ValueError('Unknown dataset format, {}'.format(format))
+
+    if format in ['csv', 'both']:
+        temp = outfile + '.tmp'
+        with open(temp, 'wb') as out:
+            for filename in filenames:
+                if os.path.exists(filename):
+                    with open(filename, 'rb') as infile:
+                        copy_lines(infile, out)
+                else:
+                    read_dataset(filename, memo=False).to_csv(out, header=False, index=False)
+        replace_path(temp, outfile)
+
+    if format in ['columnar', 'both']:
+        # Fall back to a single concatenation if there are any CSV only files
+        shards = [columnar_path(filename) for filename in filenames]
+        if not all([os.path.isdir(shard) for shard in shards]):
+            data = pd.concat([read_dataset(filename, memo=False) for filename in filenames], ignore_index=True)
+            write_dataset(outfile, data, 'columnar')
+            return
+
+        temp = prepare_temp(columnar_path(outfile))
+        shards = [shard for shard in shards if len(os.listdir(shard)) > 0]
+        for column in range(len(os.listdir(shards[0])) if len(shards) > 0 else 0):
+            name = '{}.npy'.format(column)
+            data = np.concatenate([np.load(os.path.join(shard, name), mmap_mode='r') for shard in shards])
+            np.save(os.path.join(temp, name), data, allow_pickle=False)
+        replace_path(temp, columnar_path(outfile))
+
+
+# Copy the lines of the CSV file to the output, lines that end with \r\n (e.g., 
+# from shards written by csv.writer before the line endings were fixed) are 
+# normalized to \n so the merged file is consistent
+def copy_lines(infile, out):
+    for line in infile:
+        if line.endswith(b'\r\n'):
+            line = line[:-2] + b'\n'
+        out.write(line)
+
+
+# Prepare an empty temporary directory to write the columnar copy of a dataset 
+def prepare_temp(columnar):
+    temp = columnar + '.tmp'
+    if os.path.isdir(temp):
+        shutil.rmtree(temp)
+    os.makedirs(temp)
+    return temp
+
+
+# Move the temporary file or directory into place, replacing the target
+def replace_path(temp, target):
+    if os.path.isdir(temp):
+        os.utime(temp)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+    os.replace(temp, target)
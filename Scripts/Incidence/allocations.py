@@ -15,6 +15,10 @@ import sys
 sys.path.insert(1, '../../../PSU-CIDD-MaSim-Support/Python/include')
 import database as db
 
+# The local mirror of the database, see Analysis/mirror.py
+sys.path.insert(1, '../../Analysis')
+import mirror
+
 # Connection string for the database
 CONNECTION = 'host=masimdb.vmhost.psu.edu dbname=rwanda user=sim password=sim connect_timeout=60'
 
@@ -344,7 +348,10 @@ if __name__ == "__main__":
   parser.add_argument('-y', action='store', dest='years', required=True, help='The number of years between drug rotations')
   parser.add_argument('--summarize', action='store_true', dest='summarize', help='Include to print the median district values')
   parser.add_argument('--validate', action='store_true', dest='validate', help='Include to print the validation information')
+  parser.add_argument('--mirror', action='store', dest='mirror', default=None, help='The path of a local mirror of the database to use in place of the database')
   args = parser.parse_args()
+  if args.mirror is not None:
+    CONNECTION, db = args.mirror, mirror
 
   # Make sure the years are reasonable
   years = int(args.years)
@@ -15,6 +15,10 @@ sys.path.insert(1, '../../../PSU-CIDD-MaSim-Support/Python/include')
 import ascFile as gis
 import database as db
 
+# The local mirror of the database, see Analysis/mirror.py
+sys.path.insert(1, '../../Analysis')
+import mirror
+
 # Connection string for the database
 CONNECTION = 'host=masimdb.vmhost.psu.edu dbname=rwanda user=sim password=sim connect_timeout=60'
 
@@ -178,7 +182,11 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument('-u', action='store', dest='update', default=0,
     help='Update PfPR values based upon suggested adjustments (default 0)')
+  parser.add_argument('--mirror', action='store', dest='mirror', default=None,
+    help='The path of a local mirror of the database to use in place of the database')
   args = parser.parse_args()
+  if args.mirror is not None:
+    CONNECTION, db = args.mirror, mirror
 
   # Set up the environment
   if not os.path.exists('data'):